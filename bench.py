@@ -0,0 +1,164 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+'''
+搜索基准: 在固定的局面集合上把 Searcher.search() 跑到固定深度或固定节点数(不受THINK_TIME限制),
+按局面输出 节点数/nps/每层耗时(time-to-depth)/置换表命中率/最佳着法/主要变例/选择性深度/期望窗口重搜次数,
+结果为JSON, 便于跨提交diff。
+
+局面集合: 开局库(library.kaijuku)中的局面, 固定的中局局面(MIDGAME, 随代码一起提交, 各机器、各提交之间可比),
+以及从 main() 写出的 history.json 中截取的中局局面。
+history.json 中偶数步为玩家(红方)视角, 奇数步为电脑(黑方)视角。
+注意history.json中没有暗子池信息, 统一按完整的暗子池(resetrbdict)计算。
+
+用法:
+    python bench.py --depth 4
+    python bench.py --depth 5 --history history.json --from-ply 12 --every 4 --output bench.json
+    python bench.py --depth 20 --nodes 20000
+'''
+
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import json
+import time
+from board import library
+import musesfish_pvs_20260215 as engine
+
+
+# 固定的中局局面(红方视角的FEN, X/x是还在初始位置的暗子), 由引擎低深度自我对弈到第15/24步截取
+MIDGAME = [
+    'xxxxkx1x1/9/1x2p4/2x1x4/a3c4/2P1A1R2/X7p/PX2N3P/7p1/XX1XKXX1X b',
+    'x1xxkxR2/9/1Bp5b/2x1p4/9/1aP6/X7p/P3N3P/7p1/XX1XKXX1X w',
+    'xxxxkxRx1/9/1x5x1/4x4/a6N1/4n4/X7p/1X4P2/9/XXXXKXX1c b',
+    'xxxxkxRx1/9/7x1/9/a2r5/9/X7p/1X1nP1P2/3K5/1N1X1XX1c w',
+    'xxxxkx1xx/9/4p4/2x1x4/a3c1R2/A1P1A4/8X/1X2N3P/N6p1/1cXXKXX1X b',
+    '1pxxk3x/4rb3/2p1p4/2x1x4/R8/A1P1A4/8X/1X2P3P/7p1/1NXXKX2X w',
+    'xxxk2xxx/4b1N2/3p5/x1x3x2/4r4/9/X1X1X1X1X/3BP3P/Nc7/1X1XKX1Xc b',
+    'xxxk2xx1/6N2/3p5/2x3b2/a1r3n2/6R2/1AX1X3P/3BP4/Nc7/1X1XKX1Xc w',
+]
+
+
+def load_midgame():
+    '''
+    MIDGAME转成走子方视角的局面, 返回 [(名称, Position)]
+    '''
+    positions = []
+    for n, fen in enumerate(MIDGAME):
+        board, red = engine.parse_fen(fen)
+        if not red:
+            board = board[-2::-1].swapcase() + ' '
+        positions.append(('midgame_%d' % n, engine.Position(board, 0, red, 0)))
+    return positions
+
+
+def load_history(path, from_ply=10, every=4):
+    '''
+    从history.json中每隔every步取一个局面(从第from_ply步开始), 返回 [(名称, Position)]
+    '''
+    with open(path) as f:
+        hist = json.load(f)
+    positions = []
+    for ply in sorted(map(int, hist)):
+        if ply < from_ply or (ply - from_ply) % every:
+            continue
+        b = hist[str(ply)]
+        if 'K' not in b or 'k' not in b:
+            continue
+        positions.append(('%s:%d' % (path, ply), engine.Position(b, 0, ply % 2 == 0, 0)))
+    return positions
+
+
+def suite(histories=(), from_ply=10, every=4, book=True, midgame=True):
+    positions = []
+    if book:
+        for n, b in enumerate(library.kaijuku):
+            positions.append(('kaijuku_%d' % n, engine.Position(b, 0, False, 0)))
+    if midgame:
+        positions.extend(load_midgame())
+    for path in histories:
+        positions.extend(load_history(path, from_ply, every))
+    return positions
+
+
+def run(name, pos, depth, workers=1, split_workers=1, nodes=0):
+    '''
+    定深(或定节点数)搜索一个局面, 每个局面使用新的Searcher和完整的暗子池, 结果只和局面、深度、节点数及代码有关
+    '''
+    engine.resetrbdict()
+    engine.forbidden_moves = set()
+    searcher = engine.Searcher(workers=workers, split_workers=split_workers)
+    pos = pos.set()
+    time_to_depth = []
+    info, researches = None, 0
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        limits = engine.SearchLimits(nodes=nodes, depth=depth)
+        for info in searcher.search(pos, [pos], time_limit=float('inf'), limits=limits):
+            time_to_depth.append(round(time.time() - start, 4))
+            researches += info.researches
+    used = time.time() - start
+    tp = searcher.tp
+    return {
+        'name': name,
+        'depth': info.depth if info else 0,
+        'partial': info.partial if info else False,
+        'seldepth': info.seldepth if info else 0,
+        'nodes': searcher.nodes,
+        'nps': int(searcher.nodes / max(used, 1e-9)),
+        'time': round(used, 4),
+        'time_to_depth': time_to_depth,
+        'tt_hit_rate': round(tp.hits / tp.probes, 4) if tp.probes else 0.0,
+        'hashfull': info.hashfull if info else 0,
+        'move': engine.render_tuple(info.move) if info else '',
+        'score': info.score if info else 0,
+        'pv': engine.render_pv(info.pv) if info else [],
+        'researches': researches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Jieqi fixed-depth search benchmark')
+    parser.add_argument('--depth', type=int, default=4, help='fixed search depth')
+    parser.add_argument('--nodes', type=int, default=0, help='node budget per position (0: unlimited)')
+    parser.add_argument('--history', action='append', default=[], help='history.json dumped by main(), may repeat')
+    parser.add_argument('--from-ply', type=int, default=10, help='first ply taken from each history.json')
+    parser.add_argument('--every', type=int, default=4, help='take every N-th ply from history.json')
+    parser.add_argument('--no-book', action='store_true', help='skip the opening book positions')
+    parser.add_argument('--no-midgame', action='store_true', help='skip the built-in middlegame positions')
+    parser.add_argument('--limit', type=int, default=0, help='only run the first N positions (0: all)')
+    parser.add_argument('--workers', type=int, default=1, help='Lazy SMP processes per search')
+    parser.add_argument('--split-workers', type=int, default=1, help='root-split pool processes')
+    parser.add_argument('--output', default='', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    engine.mapping = engine.B.translate_mapping(engine.B.mapping)
+    positions = suite(args.history, args.from_ply, args.every, not args.no_book, not args.no_midgame)
+    if args.limit:
+        positions = positions[:args.limit]
+
+    results = [run(name, pos, args.depth, args.workers, args.split_workers, args.nodes) for name, pos in positions]
+    nodes = sum(r['nodes'] for r in results)
+    used = sum(r['time'] for r in results)
+    report = {
+        'depth': args.depth,
+        'nodes': args.nodes,
+        'make_unmake': engine.MAKE_UNMAKE,
+        'nullmove': engine.NULLMOVE,
+        'qs': engine.QS,
+        'workers': args.workers,
+        'split_workers': args.split_workers,
+        'aspiration_delta': engine.ASPIRATION_DELTA,
+        'positions': results,
+        'total': {'nodes': nodes, 'time': round(used, 4), 'nps': int(nodes / max(used, 1e-9))},
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,23 +3,67 @@
 
 from __future__ import print_function
 import re, time
-from itertools import count
+from math import log
 from collections import namedtuple
 import random
 from board import board, common_20210815 as common, library
 from copy import deepcopy
 import json
+import os
+import sys
+import weakref
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import numpy
+except ImportError:  # numpy是可选的, 没有时calc_average用纯Python的矩阵运算
+    numpy = None
 
 SELF_PLAY = False   # True：AI vs AI; False：人机（用 input 读玩家）
 
 NULLMOVE = False  # False比True的棋子显著更高
 QS = True
+QS_DELTA_MARGIN = 100  # 静态搜索的delta剪枝余量: 站着不动的分数加上被吃子的价值再加余量仍不到alpha, 就不再搜这步吃子
+MAKE_UNMAKE = True  # True: 原地走子/撤销的搜索内核(MutablePosition); False: 每步复制局面的原内核
+EVAL_DEBUG = False  # True: Position.move()增量更新的局面属性逐项与set()全盘重算的结果比对(assert), 调试用, 很慢
+KILLER_SLOTS = 2  # 每层保存的杀手着法个数
+# 后期着法缩减(LMR): 深度>=LMR_MIN_DEPTH时, 排在第LMR_MIN_MOVES步以后的安静着法先降低深度做窄窗搜索, 超过alpha再按原深度重搜。
+# 缩减量 = LMR_BASE + ln(深度) * ln(着法序号) / LMR_DIVISOR (取整), 至少保留1层。
+LMR = True
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVES = 3
+LMR_BASE = 0.3
+LMR_DIVISOR = 2.0
+CHECK_EXTENSION = 1  # 被将军(对方下一步可以吃将)时延伸的层数, 0表示不延伸
+ASPIRATION_DELTA = 80  # 期望窗口的初始半宽, 以上一层的分数为中心; 失败时加倍重搜。0表示总是全窗搜索
 MAX_DEPTH = 20 # 受THINK_TIME限制，实际最大一般仅为5左右。
 MIN_DEPTH = 1 # 如果增大，则THINK_TIME不能过低，否则就可能超时报错。
+MAX_PLY = 64  # 搜索树的最大层数(含空着), 即杀手着法表的大小
 
 # Constants for tuning search
 DRAW_TEST = True
 THINK_TIME = 12
+# 时间管理(TimeManager): 每步的时间预算是硬限制, 用时超过其TIME_SOFT_RATIO(软限制)后不再开始新的一层;
+# 软限制之前, 按有效分支因子预测的下一层在硬限制之前完成不了也不开始。最佳着法在两层之间变化时软限制延长TIME_UNSTABLE_EXTEND倍。
+TIME_SOFT_RATIO = 0.5
+TIME_UNSTABLE_EXTEND = 1.5
+TIME_MOVES_TO_GO = 30  # 按棋钟分配时间、又不知道还要走几步时, 按还要走这么多步算
+TIME_CLOCK_MAX_SHARE = 0.3  # 按棋钟分配时, 一步最多用剩余时间的这个比例
+TIME_MIN_HARD = 0.1  # 按棋钟分配时硬限制的下限(秒), 棋钟用完也要走出一步
+GAME_CLOCK = 0  # 人机对弈时电脑的棋钟(秒), 0表示不用棋钟, 每步按THINK_TIME
+CLOCK_INCREMENT = 0  # 棋钟每步加秒
+# 搜索中检查用时和停止信号的间隔(SearchLimits): 按实测的NPS换算成节点数, 约每LIMITS_CHECK_PERIOD秒检查一次,
+# 并限制在LIMITS_CHECK_MIN..LIMITS_CHECK_MAX个节点之间
+LIMITS_CHECK_PERIOD = 0.005
+LIMITS_CHECK_MIN = 16
+LIMITS_CHECK_MAX = 4096
+PERSISTENT_TT = True  # True: 置换表跨迭代深度和跨回合保留, 按回合计年龄; False: 每回合开始时清空
+SMP_WORKERS = 1  # 并行搜索(Lazy SMP)的进程数, 1表示单进程搜索
+PONDER = True  # 人机对弈时, 电脑走完后按主要变例猜玩家的应着, 在玩家思考期间后台搜索
+ROOT_SPLIT_WORKERS = 1  # 根节点分割并行搜索的进程数, 1表示不分割
+ROOT_SPLIT_MIN_DEPTH = 3  # 深度低于此值时根节点着法太便宜, 不值得分发到进程池
 
 # THINK_TIME前N步线性增长
 RAMP_THINK_TIME = True   # 程序开始时该参数为真，则启用前N步爬升
@@ -73,6 +117,43 @@ def resetrbdict():
 pst = deepcopy(common.pst)
 discount_factor = common.discount_factor  # 1.6
 
+# 暗子池里的兵种(红方写法), 暗子池按这个顺序写成个数的向量
+AVERAGE_PIECES = 'RNBACP'
+# 各兵种在每个格子的子力价值矩阵(行: AVERAGE_PIECES, 列: 格子0..255), 不确定子的平均价值就是个数向量乘这个矩阵再除以总数。
+# 有numpy时是numpy矩阵; 没有时按列存成tuple的list, 逐格做点积
+if numpy is not None:
+    pst_matrix = numpy.array([pst[p] for p in AVERAGE_PIECES], dtype=float)
+else:
+    pst_matrix = list(zip(*(pst[p] for p in AVERAGE_PIECES)))
+AVERAGE_CACHE_SIZE = 4096
+average_cache = {}  # 个数向量 -> (暗子的平均价值, 不确定子在各格子的平均价值)
+
+
+def average_table(counts):
+    '''
+    一方暗子池(按AVERAGE_PIECES的个数向量)的平均价值: 返回 (睡着的暗子的平均价值, 翻开后在各格子的平均价值的list)。
+    结果按个数向量缓存, 暗子池没变时不重算。
+    '''
+    table = average_cache.get(counts)
+    if table is not None:
+        return table
+    n = sum(counts)
+    if n == 0:
+        table = (0, [0] * 256)
+    else:
+        covered = round(sum(pst["1"][p] * c / discount_factor for p, c in zip(AVERAGE_PIECES, counts)) / n)
+        if numpy is not None:
+            squares = numpy.rint(numpy.array(counts, dtype=float) @ pst_matrix / n).astype(int).tolist()
+        else:
+            # 只算棋盘上的格子(51..203), 与numpy的结果一致, 其余格子的价值都是0
+            squares = [0] * 256
+            squares[51:204] = [round(sum(c * v for c, v in zip(counts, column)) / n) for column in pst_matrix[51:204]]
+        table = (covered, squares)
+    if len(average_cache) >= AVERAGE_CACHE_SIZE:
+        average_cache.clear()
+    average_cache[counts] = table
+    return table
+
 A0, I0, A9, I9 = 12 * 16 + 3, 12 * 16 + 11, 3 * 16 + 3,  3 * 16 + 11
 
 '''
@@ -200,6 +281,154 @@ directions = {
     'K': (N, E, S, W)
 }
 
+###############################################################################
+# Precomputed move tables
+###############################################################################
+# 棋盘上的90个格子(升序)。gen_moves/rooted按这个顺序遍历, 走法顺序与逐格扫描时一致。
+board_squares = tuple(i for i in range(51, 204) if initial_covered[i] not in ' \n')
+
+
+def build_move_table():
+    '''
+    import时一次性算好每种棋子在每个格子上的走法, gen_moves/rooted运行时只需查表:
+    move_table[p][i]:
+        车/暗车/炮/暗炮: 各方向的射线(按directions的方向顺序, 每条射线由近到远, 到棋盘边为止)
+        马/暗马: (目标, 马腿)
+        相/暗相: (目标, 象眼)
+        其余: 目标格, 已经处理了九宫(帅)、花心(暗士)和过河才能横走(兵)的规则
+    king_fly[i]: 帅在i时向上的飞将射线
+    '''
+    on_board = set(board_squares)
+    table = {p: [()] * 256 for p in directions}
+    fly = [()] * 256
+    for i in board_squares:
+        fly[i] = tuple(range(i - 16, A9, -16))
+        for p, dirs in directions.items():
+            if p in 'RDCH':
+                rays = []
+                for d in dirs:
+                    ray = []
+                    j = i + d
+                    while j in on_board:
+                        ray.append(j)
+                        j += d
+                    if ray:
+                        rays.append(tuple(ray))
+                table[p][i] = tuple(rays)
+                continue
+            targets = []
+            for d in dirs:
+                j = i + d
+                if j not in on_board: continue
+                # 过河的卒/兵才能横着走
+                if p == 'P' and d in (E, W) and i > 128: continue
+                # j & 15 等价于 j % 16但是更快
+                if p == 'K' and (j < 160 or j & 15 > 8 or j & 15 < 6): continue
+                if p == 'G' and j != 183: continue # 暗士, 花心坐标: (11, 7), 11 * 16 + 7 = 183
+                if p in 'NE':
+                    n_diff_x = (j - i) & 15
+                    if n_diff_x == 14 or n_diff_x == 2:
+                        leg = i + (1 if n_diff_x == 2 else -1)
+                    else:
+                        leg = i + 16 if j > i else i - 16
+                    targets.append((j, leg))
+                elif p in 'BF':
+                    targets.append((j, i + d // 2))
+                else:
+                    targets.append(j)
+            table[p][i] = tuple(targets)
+    return table, fly
+
+
+move_table, king_fly = build_move_table()
+
+
+def mirror_move_table(table, fly):
+    '''
+    对方棋子的走法表: 对方视角的格子x对应走子方视角的254-x, 把move_table/king_fly整体换算到走子方视角,
+    这样不用rotate棋盘就能直接在走子方的棋盘上查对方棋子(小写)的走法
+    '''
+    m = lambda x: 254 - x
+    mirrored = {p: [()] * 256 for p in table}
+    for p, entries in table.items():
+        for i in board_squares:
+            entry = entries[254 - i]
+            if p in 'RDCH':
+                mirrored[p][i] = tuple(tuple(map(m, ray)) for ray in entry)
+            elif p in 'NEBF':
+                mirrored[p][i] = tuple((m(j), m(leg)) for j, leg in entry)
+            else:
+                mirrored[p][i] = tuple(map(m, entry))
+    mirrored_fly = [()] * 256
+    for i in board_squares:
+        mirrored_fly[i] = tuple(map(m, fly[254 - i]))
+    return mirrored, mirrored_fly
+
+
+opp_move_table, opp_king_fly = mirror_move_table(move_table, king_fly)
+
+
+def build_attack_table():
+    '''
+    反查表, 供is_attacked从被攻击的格子向外找攻击者:
+    attack_from[by_side][j]: 非直线棋子(马/相/士/帅/兵及对应的暗子)能走到j的所有 (起点, 马腿或象眼, 棋子字母),
+    by_side为True时是走子方(大写)的棋子, False时是对方(小写)的棋子, 坐标都是走子方视角。
+    车/炮的直线是对称的, 直接沿move_table['R'][j]的射线反查即可, 不放在表里。
+    '''
+    result = {}
+    for by_side, table in ((True, move_table), (False, opp_move_table)):
+        found = [dict() for _ in range(256)]
+        for p in 'NEBFAGKPI':
+            letter = p if by_side else p.lower()
+            for i in board_squares:
+                for entry in table[p][i]:
+                    j, block = entry if p in 'NEBF' else (entry, None)
+                    found[j][i, block] = found[j].get((i, block), '') + letter
+        result[by_side] = [tuple((i, block, letters) for (i, block), letters in d.items()) for d in found]
+    return result
+
+
+attack_from = build_attack_table()
+
+
+def square_attacked(board, square, by_side):
+    '''
+    格子square能否被by_side一方(True: 走子方, False: 对方)的棋子吃到, board可以是字符串或列表(试走着法用的临时棋盘)。
+    从square向外找: 车线上的第一个子是车/暗车, 隔一个炮架的是炮/暗炮, 再查马腿、象眼、士、帅、兵的反查表;
+    square上是将(帅)时还要看飞将。不rotate棋盘, 也不生成着法。
+    '''
+    if by_side:
+        rook, cannon, king, target = 'RD', 'CH', 'K', 'k'
+    else:
+        rook, cannon, king, target = 'rd', 'ch', 'k', 'K'
+    for ray in move_table['R'][square]:
+        screen = False
+        for j in ray:
+            q = board[j]
+            if q == '.':
+                continue
+            if screen:
+                if q in cannon:
+                    return True
+                break
+            if q in rook:
+                return True
+            screen = True
+    for i, block, letters in attack_from[by_side][square]:
+        if board[i] in letters and (block is None or board[block] == '.'):
+            return True
+    if board[square] == target:
+        # 飞将: 走子方的帅在下方, 对方的将在上方
+        step = 16 if by_side else -16
+        j = square + step
+        while 51 <= j <= 203:
+            q = board[j]
+            if q != '.':
+                return q == king
+            j += step
+    return False
+
+
 uni_pieces = {
     '.': '．',
     'R': '\033[31m俥\033[0m',
@@ -233,8 +462,9 @@ uni_pieces = {
 MATE_LOWER = piece['K'] - (2*piece['R'] + 2*piece['N'] + 2*piece['B'] + 2*piece['A'] + 2*piece['C'] + 5*piece['P'])
 MATE_UPPER = piece['K'] + (2*piece['R'] + 2*piece['N'] + 2*piece['B'] + 2*piece['A'] + 2*piece['C'] + 5*piece['P'])
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The table size is the number of entries in the transposition table (must be a power of two).
+# 每个桶2个槽(深度优先槽 + 总是替换槽), 内存固定为 TABLE_SIZE * 30 字节左右。
+TABLE_SIZE = 1 << 20
 
 
 
@@ -268,6 +498,42 @@ average = {0: {}}
 #                     pos: 棋盘位置
 #               False: 正在睡觉的暗子
 
+###############################################################################
+# Zobrist hashing
+###############################################################################
+# 与C++版AIBoard5的_zobrist/zobrist_hash一致: 键值按红方视角(绝对坐标)计算,
+# 因此rotate只需异或zobrist_turn, move只需异或起点/终点的增量。
+# zobrist[turn][p][i]: 走子方为turn时, 走子方视角下位置i上的棋子p对应的随机数。
+# 空位'.'全部为0, 这样走子/吃子时不需要特判。
+# 注意: 键值只包含棋盘和走子方, 不包含score。以前的置换表以整个Position(含score)为键, 而score里有沿路径累加的value()奖励,
+# 键值相同的两个局面score可能不同。因此置换表里的上下界只在同一个搜索根节点(同一次search)内可比, 换了根节点只能用着法排序。
+_zobrist_rng = random.Random(20210815)  # 固定种子, 不影响全局random(暗子映射)
+_zobrist_red = {p: ([0] * 256 if p == '.' else [_zobrist_rng.getrandbits(64) for _ in range(256)])
+                for p in '.RNBAKCPDEFGHIUrnbakcpdefghiu'}
+zobrist = {
+    True: _zobrist_red,
+    False: {p: [_zobrist_red[p.swapcase()][254 - i] for i in range(256)] for p in _zobrist_red}
+}
+zobrist_turn = _zobrist_rng.getrandbits(64)
+
+
+def calc_zobrist(board, turn):
+    '''
+    从头计算局面的Zobrist键值, 只在新建局面(不经过move)时调用
+    '''
+    z = zobrist[turn]
+    h = 0 if turn else zobrist_turn
+    for i in range(51, 204):
+        p = board[i]
+        if p in z:
+            h ^= z[p][i]
+    return h
+
+# Position.move()增量维护、EVAL_DEBUG时与set()比对的属性
+INCREMENTAL_FIELDS = ('score_rough', 'che', 'che_opponent', 'covered', 'covered_opponent', 'zu', 'zu_opponent',
+                      'endline', 'endline_opponent', 'kongtoupao', 'kongtoupao_opponent',
+                      'kongtou_score', 'kongtou_score_opponent', 'possible_che', 'possible_che_opponent', 'bing_prob')
+
 ###############################################################################
 # Chess logic
 ###############################################################################
@@ -276,26 +542,31 @@ class Position(namedtuple('Position', 'board score turn version')):
     """ A state of a chess game
     board -- a 256 char representation of the board
     score -- the board evaluation
+    zobrist_hash -- 64位Zobrist键值(属性, 由move/rotate增量维护), 置换表以它为键。不含score, 键值相同的局面score可能不同
     """
 
     def set(self):
 
+        if getattr(self, 'zobrist_hash', None) is None:
+            self.zobrist_hash = calc_zobrist(self.board, self.turn)
+
         self.che = 0
         self.che_opponent = 0
         self.zu = 0
+        self.zu_opponent = 0
         self.covered = 0
         self.covered_opponent = 0
         self.endline = 0
+        self.endline_opponent = 0  # 对方视角下的endline, 只为move()增量更新子局面而保存
         self.score_rough = 0
-        self.kongtoupao = 0
-        self.kongtoupao_opponent = 0
-        self.kongtou_score = 0
-        self.kongtou_score_opponent=0
 
         for i in range(51, 204):
             if i >> 4 == 3:
                 if self.board[i] in 'defgrnc':
                     self.endline += 1
+            elif i >> 4 == 12:
+                if self.board[i] in 'DEFGRNC':
+                    self.endline_opponent += 1
 
             p = self.board[i]
 
@@ -328,12 +599,35 @@ class Position(namedtuple('Position', 'board score turn version')):
             if p == 'P':
                 self.zu += 1
 
-            if p == 'C' and i & 15 == 7:
-                self.check_kongtoupao(i, True)
+            if p == 'p':
+                self.zu_opponent += 1
+
+        self.set_kongtoupao()
+        self.set_kongtou_score()
+        self.set_possibility()
+
+        # rooted cache (optional but recommended)
+        self._rooted_cache = None
+        self._attack_map = None
+        
+        return self
 
-            if p == 'c' and i & 15 == 7:
+    def set_kongtoupao(self):
+        '''
+        扫描中路, 计算双方的空头炮(按从上到下的顺序, 与逐格扫描一致)
+        '''
+        self.kongtoupao = 0
+        self.kongtoupao_opponent = 0
+        board = self.board
+        for i in range(55, 204, 16):
+            if board[i] == 'C':
+                self.check_kongtoupao(i, True)
+            elif board[i] == 'c':
                 self.check_kongtoupao(i, False)
-       
+
+    def set_kongtou_score(self):
+        self.kongtou_score = 0
+        self.kongtou_score_opponent = 0
         if (self.kongtoupao > 0 and self.kongtoupao_opponent <= 0) or (self.kongtoupao > self.kongtoupao_opponent > 0):
             if (self.che >= self.che_opponent and self.che > 0) or self.kongtoupao >= 3:
                 self.kongtou_score += 100
@@ -346,6 +640,7 @@ class Position(namedtuple('Position', 'board score turn version')):
             else:
                 self.kongtou_score_opponent += 70
 
+    def set_possibility(self):
         # ---- Precompute constants used by value() a lot (speed) ----
         my_sum = sumall[self.version][self.turn]
         op_sum = sumall[self.version][not self.turn]
@@ -362,11 +657,6 @@ class Position(namedtuple('Position', 'board score turn version')):
         else:
             self.possible_che_opponent = 0.0
 
-        # rooted cache (optional but recommended)
-        self._rooted_cache = None
-        
-        return self
-
     def check_kongtoupao(self, pos, t):
         cannon = 'C' if t else 'c'
         king = 'k' if t else 'K'
@@ -405,103 +695,122 @@ class Position(namedtuple('Position', 'board score turn version')):
 
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
-        # as defined in the 'directions' map. The rays are broken e.g. by
+        # as precomputed in move_table. The rays are broken e.g. by
         # captures or immediately in case of pieces such as knights.
-        for i in range(51, 204):
+        board = self.board
+        for i in board_squares:
 
-            p = self.board[i]
+            p = board[i]
 
             if not p.isupper() or p == 'U': continue
 
-            if p == 'K': 
-                for scanpos in range(i - 16, A9, -16):
-                    if self.board[scanpos] == 'k':
-                        yield (i, scanpos)
-                    elif self.board[scanpos] != '.':
-                        break
+            if p == 'R' or p == 'D': #明暗车
+                for ray in move_table[p][i]:
+                    for j in ray:
+                        q = board[j]
+                        if q == '.': yield (i, j)
+                        else:
+                            if q.islower(): yield (i, j)
+                            break
 
-            if p in ('C', 'H'): #明暗炮
-                for d in directions[p]:
+            elif p == 'C' or p == 'H': #明暗炮
+                for ray in move_table[p][i]:
                     cfoot = 0
-                    for j in count(i+d, d):
-                        q = self.board[j]
-                        if q == ' ' or q == '\n': break
-                        if cfoot == 0 and q == '.': yield (i, j)
-                        elif cfoot == 0 and q != '.': cfoot += 1
-                        elif cfoot == 1 and q.islower(): yield (i, j); break
-                        elif cfoot == 1 and q.isupper(): break;
-                continue
+                    for j in ray:
+                        q = board[j]
+                        if cfoot == 0:
+                            if q == '.': yield (i, j)
+                            else: cfoot = 1
+                        elif q != '.':
+                            if q.islower(): yield (i, j)
+                            break
 
-            for d in directions[p]:
-                for j in count(i+d, d):
-                    q = self.board[j]
-                    # Stay inside the board, and off friendly pieces
-                    if q.isspace() or q.isupper(): break
-                    # 过河的卒/兵才能横着走
-                    if p == 'P' and d in (E, W) and i > 128: break
-                    # j & 15 等价于 j % 16但是更快
-                    elif p == 'K' and (j < 160 or j & 15 > 8 or j & 15 < 6): break
-                    elif p == 'G' and j != 183: break # 暗士, 花心坐标: (11, 7), 11 * 16 + 7 = 183
-                    elif p in ('N', 'E'): # 暗马
-                        n_diff_x = (j - i) & 15
-                        if n_diff_x == 14 or n_diff_x == 2:
-                            if self.board[i + (1 if n_diff_x == 2 else -1)] != '.': break
-                        else:
-                            if j > i and self.board[i + 16] != '.': break
-                            elif j < i and self.board[i - 16] != '.': break
-                    elif p in ('B', 'F') and self.board[i + d // 2] != '.': break
-                    # Move it
-                    yield (i, j)
-                    # Stop crawlers from sliding, and sliding after captures
-                    if p in 'PNBAKIEFG' or q.islower(): break
+            elif p in 'NEBF': #明暗马/相, 马腿或象眼有子则不能走
+                for j, leg in move_table[p][i]:
+                    if board[leg] == '.' and not board[j].isupper(): yield (i, j)
+
+            else:
+                if p == 'K':
+                    for scanpos in king_fly[i]:
+                        if board[scanpos] == 'k':
+                            yield (i, scanpos)
+                        elif board[scanpos] != '.':
+                            break
+                for j in move_table[p][i]:
+                    if not board[j].isupper(): yield (i, j)
 
     def rooted(self):
         '''
-        计算有根子
+        计算有根子(被己方棋子保护的己方棋子所在的格子)
         '''
-        rooted_chesses = set()
-        for i in range(51, 204):
+        return self.attack_map().rooted()
 
-            p = self.board[i]
+    def is_attacked(self, square, by_side):
+        '''
+        格子square能否被by_side一方(True: 走子方, False: 对方)的棋子吃到, 见square_attacked
+        '''
+        return square_attacked(self.board, square, by_side)
 
-            if not p.isupper() or p == 'U': continue
+    def legal_moves(self, moves=None, in_check=None):
+        '''
+        合法着法: 从gen_moves()(或传入的moves)中去掉走完后自己的帅(将)被对方吃到的着法(送将、被牵制的子离开、不应将)。
+        没被将军时, 不动帅、起点不在帅的横线/竖线上也不在帅的斜角相邻格(马腿、象眼)、终点不在帅的横线/竖线上(不会成为炮架)
+        的着法不可能送将, 直接保留; 其余着法在棋盘上试走一步, 用square_attacked检查帅的格子。
+        in_check: 调用方已知的将军状态, None表示在这里计算。
+        '''
+        if moves is None:
+            moves = list(self.gen_moves())
+        board = self.board
+        if 'K' not in board:
+            return moves
+        king = board.index('K')
+        if in_check is None:
+            in_check = square_attacked(board, king, False)
+        kr, kc = king >> 4, king & 15
+        legal = []
+        scratch = None
+        for move in moves:
+            i, j = move
+            if not in_check and i != king and (i >> 4) != kr and (i & 15) != kc and j >> 4 != kr and j & 15 != kc \
+                    and not (abs((i >> 4) - kr) == 1 and abs((i & 15) - kc) == 1):
+                legal.append(move)
+                continue
+            if scratch is None:
+                scratch = board if isinstance(board, list) else list(board)
+            p, q = scratch[i], scratch[j]
+            scratch[j], scratch[i] = p, '.'
+            attacked = square_attacked(scratch, j if i == king else king, False)
+            scratch[i], scratch[j] = p, q
+            if not attacked:
+                legal.append(move)
+        return legal
+
+    def in_check(self):
+        '''
+        走子方是否被将军(对方下一步可以吃将)
+        '''
+        board = self.board
+        if 'K' not in board:
+            return False
+        return self.is_attacked(board.index('K'), False)
 
-            if p in ('C', 'H'): #明暗炮
-                for d in directions[p]:
-                    cfoot = 0
-                    for j in count(i+d, d):
-                        q = self.board[j]
-                        if q == ' ' or q == '\n': break
-                        if cfoot == 0 and q == '.': continue
-                        elif cfoot == 0 and q != '.': cfoot += 1
-                        elif cfoot == 1 and q.islower(): break
-                        elif cfoot == 1 and q.isupper(): rooted_chesses.add(j); break
-                    continue
+    def can_capture_king(self):
+        '''
+        走子方能否直接吃掉对方的将(帅)
+        '''
+        board = self.board
+        if 'k' not in board:
+            return False
+        return self.is_attacked(board.index('k'), True)
 
-            else:
-                for d in directions[p]:
-                    for j in count(i+d, d):
-                        q = self.board[j]
-                        # Stay inside the board, and off friendly pieces
-                        # 过河的卒/兵才能横着走
-                        if q.isspace() or q.islower(): break
-                        if p == 'P' and d in (E, W) and i > 128: break
-                        # j & 15 等价于 j % 16但是更快
-                        elif p == 'K' and (j < 160 or j & 15 > 8 or j & 15 < 6): break
-                        elif p == 'G' and j != 183: break # 暗士, 花心坐标: (11, 7), 11 * 16 + 7 = 183
-                        elif p in ('N', 'E'): # 暗马
-                            n_diff_x = (j - i) & 15
-                            if n_diff_x == 14 or n_diff_x == 2:
-                                if self.board[i + (1 if n_diff_x == 2 else -1)] != '.': break
-                            else:
-                                if j > i and self.board[i + 16] != '.': break
-                                elif j < i and self.board[i - 16] != '.': break
-                        elif p in ('B', 'F') and self.board[i + d // 2] != '.': break
-                        # Move it
-                        if q.isupper(): rooted_chesses.add(j); break
-                        # Stop crawlers from sliding, and sliding after captures
-                        if p in 'PNBAKIEFG': break
-        return rooted_chesses
+    def attack_map(self):
+        '''
+        本局面的攻击表, 第一次用到时才建立, 之后有根子、将军判断、静态搜索都共用这一张表
+        '''
+        amap = getattr(self, "_attack_map", None)
+        if amap is None:
+            amap = self._attack_map = AttackMap(self)
+        return amap
 
     def rooted_cached(self):
         c = getattr(self, "_rooted_cache", None)
@@ -515,13 +824,17 @@ class Position(namedtuple('Position', 'board score turn version')):
         ''' Rotates the board, preserving enpassant '''
         p = Position(
             self.board[-2::-1].swapcase() + " ", -self.score, not self.turn, self.version)
+        if getattr(self, 'zobrist_hash', None) is not None:
+            p.zobrist_hash = self.zobrist_hash ^ zobrist_turn
         p.set()
         return p
 
     @staticmethod
-    def rotate_new(board, score, turn, version):
+    def rotate_new(board, score, turn, version, zobrist_hash=None):
         p = Position(
             board[-2::-1].swapcase() + " ", -score, not turn, version)
+        if zobrist_hash is not None:
+            p.zobrist_hash = zobrist_hash
         p.set()
         return p
 
@@ -535,12 +848,79 @@ class Position(namedtuple('Position', 'board score turn version')):
         movevalue = self.value(move)
         score = self.score + movevalue if movevalue < MATE_UPPER else MATE_UPPER
         # Actual move
-        if self.board[i] in 'RNBAKCP':
-            board = put(self.board, j, self.board[i])
+        p, q = self.board[i], self.board[j]
+        if p in 'RNBAKCP':
+            board = put(self.board, j, p)
         else:
             board = put(self.board, j, 'U')
         board = put(board, i, '.')
-        return Position.rotate_new(board, score, self.turn, self.version)
+        # Zobrist增量: 移走起点的子, 移走终点被吃的子, 放上终点的新子, 再换走子方
+        z = zobrist[self.turn]
+        key = self.zobrist_hash ^ z[p][i] ^ z[q][j] ^ z[board[j]][j] ^ zobrist_turn
+        child = Position(board[-2::-1].swapcase() + " ", -score, not self.turn, self.version)
+        child.zobrist_hash = key
+        self.update_child(child, move, p, q)
+        if EVAL_DEBUG:
+            full = Position(*child)
+            full.zobrist_hash = key
+            full.set()
+            for name in INCREMENTAL_FIELDS:
+                assert getattr(child, name) == getattr(full, name), (name, getattr(child, name), getattr(full, name))
+        return child
+
+    def update_child(self, child, move, p, q):
+        '''
+        由走子的增量(走的子p、被吃的子q、暗子翻成U)计算子局面child的score_rough/covered/che/zu/endline,
+        不再对child调用set()全盘扫描; 空头炮只扫描中路。结果与child.set()完全一致, 与MutablePosition.make的增量相同。
+        '''
+        i, j = move
+        t = self.turn
+        avg = average[self.version]
+        rough = self.score_rough
+        che_opponent, zu_opponent, covered_opponent = self.che_opponent, self.zu_opponent, self.covered_opponent
+        endline, endline_opponent = self.endline, self.endline_opponent
+
+        # 己方: 暗子翻成不确定子U, covered不变
+        if p in 'RNBAKCP':
+            rough += pst[p][j] - pst[p][i]
+            np = p
+        else:
+            rough += avg[t][True][j]
+            if p == 'U':
+                rough -= avg[t][True][i]
+            np = 'U'
+        if i >> 4 == 12 and p in 'DEFGRNC':
+            endline_opponent -= 1
+        if j >> 4 == 12 and np in 'RNC':
+            endline_opponent += 1
+
+        # 吃子
+        if q != '.':
+            k = 254 - j
+            if q in 'rnbakcp':
+                rough += pst[q.upper()][k]
+                if q == 'r':
+                    che_opponent -= 1
+                elif q == 'p':
+                    zu_opponent -= 1
+            else:
+                if q == 'u':
+                    rough += avg[not t][True][k]
+                covered_opponent -= 1
+            if j >> 4 == 3 and q in 'defgrnc':
+                endline -= 1
+
+        # 子局面是对方视角, 双方的计数互换
+        child.score_rough = -rough
+        child.che, child.che_opponent = che_opponent, self.che
+        child.covered, child.covered_opponent = covered_opponent, self.covered
+        child.zu, child.zu_opponent = zu_opponent, self.zu
+        child.endline, child.endline_opponent = endline_opponent, endline
+        child.set_kongtoupao()
+        child.set_kongtou_score()
+        child.set_possibility()
+        child._rooted_cache = None
+        child._attack_map = None
 
     def mymove_check(self, move, discount_red=True, discount_black=False):
         if move is None:
@@ -685,7 +1065,7 @@ class Position(namedtuple('Position', 'board score turn version')):
             score = average[self.version][self.turn][True][j] - average[self.version][self.turn][False] + 20  # 相应位置不确定明子的平均价值 - 暗子
 
             if p == 'D':
-                minus = 30*(possible_che_opponent / 2 + self.che_opponent)
+                minus = round(30*(possible_che_opponent / 2 + self.che_opponent))
                 score -= minus  # 暗车溜出，扣分! 扣的分数和对方剩余车的个数有关
                 if self.score_rough < -150:
                     score -= minus//2
@@ -756,7 +1136,7 @@ class Position(namedtuple('Position', 'board score turn version')):
                         elif self.board[scanpos] == 'r':
                             che_opponent_onleidao += 1
                     if cheonleidao > che_opponent_onleidao and possible_che >= possible_che_opponent:
-                        score += (40 * self.calc())
+                        score += round(40 * self.calc())
 
                 # 对手1路暗车出动， 己方可以考虑出将/出帅助攻。翻开六路暗士， 查看六路肋道车的数量。如果己方车数量大于对方车，鼓励翻动士助攻
                 elif i == 198 and self.board[51] not in 'dr' and self.board[54] != 'a' and self.board[71] != 'a' and (
@@ -769,7 +1149,7 @@ class Position(namedtuple('Position', 'board score turn version')):
                         elif self.board[scanpos] == 'r':
                             che_opponent_onleidao += 1
                     if cheonleidao > che_opponent_onleidao and possible_che >= possible_che_opponent:
-                        score += (40 * self.calc())
+                        score += round(40 * self.calc())
 
                 elif sumall[self.version][self.turn] > 0 and \
                         (di[self.version][self.turn]['P' if self.turn else 'p'] * self.covered /
@@ -832,100 +1212,879 @@ class Position(namedtuple('Position', 'board score turn version')):
                     if j >> 4 == 7 and j & 1 == 1: 
                        score += 10 #吃由暗兵翻出来的不确定子加分，鼓励控制暗兵
                 if q == 'D':
-                    addition = 30*(possible_che/2 + self.che)
+                    addition = round(30*(possible_che/2 + self.che))
                     score += addition  # 吃对方暗车，加分! 加的分数和己方剩余车的个数相关，如果本方没有车了，那吃个暗车不算太大的收益
                     if self.score_rough > 150:
                         score += addition//2
 
         return score
 
+class MutablePosition:
+    '''
+    原地走子/撤销(make/unmake)的搜索局面, 只在Searcher内部使用。
+    同时保存走子方/对方两个视角的棋盘(list), 走一步只改4个格子, rotate只是切换视角,
+    score_rough/covered/che/endline/空头炮等由走子增量更新, 不再每个节点复制字符串并调用set()全盘扫描。
+    棋盘用单字符list而不是bytearray, 这样gen_moves/value/rooted可以直接复用Position的实现。
+    每次make后的各项属性与Position.move()得到的新局面完全一致。
+    '''
+
+    gen_moves = Position.gen_moves
+    rooted = Position.rooted
+    rooted_cached = Position.rooted_cached
+    attack_map = Position.attack_map
+    is_attacked = Position.is_attacked
+    legal_moves = Position.legal_moves
+    in_check = Position.in_check
+    can_capture_king = Position.can_capture_king
+    value = Position.value
+    calc = Position.calc
+    check_kongtoupao = Position.check_kongtoupao
+    set_kongtoupao = Position.set_kongtoupao
+    set_kongtou_score = Position.set_kongtou_score
+    set_possibility = Position.set_possibility
+
+    def __init__(self, pos):
+        pos.set()
+        opp = pos.rotate()
+        self.boards = {pos.turn: list(pos.board), opp.turn: list(opp.board)}
+        self.board = self.boards[pos.turn]
+        self.score = pos.score
+        self.turn = pos.turn
+        self.version = pos.version
+        self.zobrist_hash = pos.zobrist_hash
+        self.score_rough = pos.score_rough
+        self.che, self.che_opponent = pos.che, pos.che_opponent
+        self.covered, self.covered_opponent = pos.covered, pos.covered_opponent
+        self.zu, self.zu_opponent = pos.zu, pos.zu_opponent
+        self.endline, self.endline_opponent = pos.endline, pos.endline_opponent
+        self.kongtoupao, self.kongtoupao_opponent = pos.kongtoupao, pos.kongtoupao_opponent
+        # 两个视角下的空头炮计数, 只有中路(i & 15 == 7)有变化时才需要重新扫描
+        self._kongtou = {pos.turn: (pos.kongtoupao, pos.kongtoupao_opponent),
+                         opp.turn: (opp.kongtoupao, opp.kongtoupao_opponent)}
+        self.set_kongtou_score()
+        self.set_possibility()
+        self._rooted_cache = None
+        self._attack_map = None
+        self._undo = []
+
+    @property
+    def ply(self):
+        '''
+        从搜索根节点走过的步数(含空着)
+        '''
+        return len(self._undo)
+
+    def snapshot(self):
+        '''
+        当前局面的不可变Position副本
+        '''
+        p = Position(''.join(self.board), self.score, self.turn, self.version)
+        p.zobrist_hash = self.zobrist_hash
+        return p.set()
+
+    def make(self, move):
+        i, j = move
+        t = self.turn
+        b, ob = self.board, self.boards[not t]
+        p, q = b[i], b[j]
+        movevalue = self.value(move)
+        score = self.score + movevalue if movevalue < MATE_UPPER else MATE_UPPER
+        # 浅拷贝属性字典作为撤销记录, 棋盘list是共享的, unmake时单独恢复
+        self._undo.append((i, j, p, q, self.__dict__.copy()))
+
+        np = p if p in 'RNBAKCP' else 'U'
+        b[i] = '.'
+        b[j] = np
+        ob[254 - i] = '.'
+        ob[254 - j] = np.lower()
+        z = zobrist[t]
+        self.zobrist_hash ^= z[p][i] ^ z[q][j] ^ z[np][j] ^ zobrist_turn
+
+        # 己方: 暗子翻成不确定子U, covered不变
+        avg = average[self.version]
+        rough = self.score_rough
+        if p in 'RNBAKCP':
+            rough += pst[p][j] - pst[p][i]
+        else:
+            rough += avg[t][True][j]
+            if p == 'U':
+                rough -= avg[t][True][i]
+        if (254 - i) >> 4 == 3 and p in 'DEFGRNC':
+            self.endline_opponent -= 1
+        if (254 - j) >> 4 == 3 and np in 'RNC':
+            self.endline_opponent += 1
+
+        # 吃子
+        if q != '.':
+            k = 254 - j
+            if q in 'rnbakcp':
+                rough += pst[q.upper()][k]
+                if q == 'r':
+                    self.che_opponent -= 1
+                elif q == 'p':
+                    self.zu_opponent -= 1
+            else:
+                if q == 'u':
+                    rough += avg[not t][True][k]
+                self.covered_opponent -= 1
+            if j >> 4 == 3 and q in 'defgrnc':
+                self.endline -= 1
+
+        if (i & 15) == 7 or (j & 15) == 7:
+            self._kongtou = {}
+        self.score = score
+        self.score_rough = rough
+        self._flip()
+
+    def make_null(self):
+        '''
+        空着: 只换走子方, 相当于Position.nullmove()/rotate()
+        '''
+        self._undo.append((None, None, None, None, self.__dict__.copy()))
+        self.zobrist_hash ^= zobrist_turn
+        self._flip()
+
+    def unmake(self):
+        i, j, p, q, state = self._undo.pop()
+        if i is not None:
+            b, ob = self.boards[state['turn']], self.boards[not state['turn']]
+            b[i] = p
+            b[j] = q
+            ob[254 - i] = p.swapcase()
+            ob[254 - j] = q.swapcase()
+        self.__dict__ = state
+
+    def _flip(self):
+        t = not self.turn
+        self.turn = t
+        self.board = self.boards[t]
+        self.score = -self.score
+        self.score_rough = -self.score_rough
+        self.che, self.che_opponent = self.che_opponent, self.che
+        self.covered, self.covered_opponent = self.covered_opponent, self.covered
+        self.zu, self.zu_opponent = self.zu_opponent, self.zu
+        self.endline, self.endline_opponent = self.endline_opponent, self.endline
+        kongtou = self._kongtou.get(t)
+        if kongtou is None:
+            self.set_kongtoupao()
+            self._kongtou = dict(self._kongtou)
+            self._kongtou[t] = (self.kongtoupao, self.kongtoupao_opponent)
+        else:
+            self.kongtoupao, self.kongtoupao_opponent = kongtou
+        self.set_kongtou_score()
+        self.set_possibility()
+        self._rooted_cache = None
+        self._attack_map = None
+
+
+class PositionStack:
+    '''
+    make/unmake接口下的原搜索内核: 每步仍用Position.move()复制出新局面, 压栈保存。
+    MAKE_UNMAKE = False 时使用, 便于与MutablePosition对比结果和速度。
+    '''
+
+    def __init__(self, pos):
+        self.stack = [pos]
+
+    def __getattr__(self, name):
+        return getattr(self.stack[-1], name)
+
+    @property
+    def ply(self):
+        return len(self.stack) - 1
+
+    def snapshot(self):
+        return self.stack[-1]
+
+    def make(self, move):
+        self.stack.append(self.stack[-1].move(move))
+
+    def make_null(self):
+        self.stack.append(self.stack[-1].nullmove())
+
+    def unmake(self):
+        self.stack.pop()
+
+
+###############################################################################
+# Attack map
+###############################################################################
+
+class AttackMap:
+    '''
+    攻击表: 对棋盘上每个有子的格子, 列出走子方(mine)和对方(theirs)能吃到/保护它的棋子所在的格子。
+    坐标都是走子方视角, 对方棋子用mirror过的走法表直接在同一张棋盘上查, 不需要rotate。
+    炮架、马腿、象眼和飞将都已考虑; 不确定子U不能走, 不参与攻击。
+    通过Position.attack_map()按局面缓存, 有根子(rooted)、静态搜索的吃子着法和静态交换评估(see)都共用一张表,
+    不再各自扫描棋盘或对rotate后的局面调用gen_moves()。只问一个格子时用Position.is_attacked, 不必建整张表。
+    MutablePosition的unmake会连同缓存一起恢复上一层的局面, 回到上一层时不需要重建。
+    mine/theirs两半各自在第一次用到时才扫描。
+    '''
+
+    def __init__(self, pos):
+        self.board = pos.board
+        self.version = pos.version
+        self.turn = pos.turn
+        self._mine = None
+        self._theirs = None
+
+    @property
+    def mine(self):
+        if self._mine is None:
+            self._mine = self._scan(self.board, True)
+        return self._mine
+
+    @property
+    def theirs(self):
+        if self._theirs is None:
+            self._theirs = self._scan(self.board, False)
+        return self._theirs
+
+    @staticmethod
+    def _scan(board, upper):
+        attacks = {}
+        table, fly = (move_table, king_fly) if upper else (opp_move_table, opp_king_fly)
+        king = 'k' if upper else 'K'
+        for i in board_squares:
+            p = board[i]
+            if p == '.' or p.isupper() != upper:
+                continue
+            p = p.upper()
+            if p == 'U':
+                continue
+
+            if p == 'R' or p == 'D':
+                for ray in table[p][i]:
+                    for j in ray:
+                        if board[j] != '.':
+                            attacks.setdefault(j, []).append(i)
+                            break
+
+            elif p == 'C' or p == 'H':
+                for ray in table[p][i]:
+                    cfoot = 0
+                    for j in ray:
+                        if board[j] != '.':
+                            if cfoot:
+                                attacks.setdefault(j, []).append(i)
+                                break
+                            cfoot = 1
+
+            elif p in 'NEBF':
+                for j, leg in table[p][i]:
+                    if board[leg] == '.' and board[j] != '.':
+                        attacks.setdefault(j, []).append(i)
+
+            else:
+                if p == 'K':
+                    for j in fly[i]:
+                        if board[j] != '.':
+                            if board[j] == king:
+                                attacks.setdefault(j, []).append(i)
+                            break
+                for j in table[p][i]:
+                    if board[j] != '.':
+                        attacks.setdefault(j, []).append(i)
+        return attacks
+
+    def rooted(self):
+        '''
+        走子方被己方保护的棋子所在的格子
+        '''
+        board = self.board
+        return {j for j in self.mine if board[j].isupper()}
+
+    def piece_value(self, i):
+        '''
+        格子i上棋子的价值: 明子按子力价值, 暗子按该方暗子的平均价值, 不确定子按该格子上的平均明子价值
+        '''
+        p = self.board[i]
+        mine = p.isupper()
+        p = p.upper()
+        if p in piece:
+            return piece[p]
+        avg = average[self.version][self.turn if mine else not self.turn]
+        if p == 'U':
+            return avg[True][i if mine else 254 - i]
+        return avg[False]
+
+    def captures(self):
+        '''
+        走子方所有的吃子着法, 按MVV-LVA排序(被吃子价值高的在前, 同一目标用价值低的子去吃)
+        '''
+        board, value = self.board, self.piece_value
+        moves = [(i, j) for j, attackers in self.mine.items() if board[j].islower() for i in attackers]
+        moves.sort(key=lambda m: (value(m[1]), -value(m[0])), reverse=True)
+        return moves
+
+    def see(self, move):
+        '''
+        静态交换评估: 双方轮流用最便宜的子在move的目标格上兑子, 返回走子方的净得失(任何一方都可以随时停止)。
+        近似: 兑子过程中不重新计算被打开的车线、炮架的变化。
+        '''
+        i, j = move
+        value = self.piece_value
+        sides = [sorted(self.theirs.get(j, ()), key=value),
+                 sorted((x for x in self.mine.get(j, ()) if x != i), key=value)]
+        gain = [value(j)]
+        on_square = value(i)
+        side = 0
+        while sides[side]:
+            gain.append(on_square - gain[-1])
+            on_square = value(sides[side].pop(0))
+            side ^= 1
+        for d in range(len(gain) - 1, 0, -1):
+            gain[d - 1] = -max(-gain[d - 1], gain[d])
+        return gain[0]
+
+
 ###############################################################################
 # Search logic
 ###############################################################################
 
+def build_lmr_table():
+    '''
+    lmr_table[depth][n]: 深度为depth的节点上第n步(从0开始)着法的缩减层数
+    '''
+    table = []
+    for depth in range(MAX_PLY):
+        row = []
+        for n in range(256):
+            if depth < LMR_MIN_DEPTH or n < LMR_MIN_MOVES:
+                row.append(0)
+            else:
+                r = int(LMR_BASE + log(depth) * log(n) / LMR_DIVISOR)
+                row.append(max(0, min(r, depth - 2)))
+        table.append(row)
+    return table
+
+
+lmr_table = build_lmr_table()
+
 # lower <= s(pos) <= upper
 Entry = namedtuple('Entry', 'lower upper')
+ENTRY_EMPTY = Entry(-MATE_UPPER, MATE_UPPER)
+
+# search()每完成一层输出的记录: 深度、最大选择性深度、分数、累计节点数、nps、用时(秒)、置换表占用(千分比)、
+# 主要变例(从根节点起双方交替的着法, 各自为当时走子方视角的坐标)、期望窗口重搜次数、
+# partial(这一层超时没有搜完, 着法是这一层已经证明比上一层最佳着法更好的着法, 分数是它的下界)
+SearchInfo = namedtuple('SearchInfo', 'depth move score seldepth nodes nps time hashfull pv researches partial',
+                        defaults=(False,))
+
+
+def mate_to_tt(score, ply):
+    '''
+    杀棋分数按"离根节点的步数"计(MATE_UPPER - ply), 存入置换表前换算成"离本节点的步数", 不同路径到达同一局面时才能共用
+    '''
+    if MATE_LOWER <= score < MATE_UPPER:
+        return score + ply
+    if -MATE_UPPER < score <= -MATE_LOWER:
+        return score - ply
+    return score
+
+
+def mate_from_tt(score, ply):
+    '''
+    mate_to_tt的逆运算: 从置换表取出的杀棋分数换算回离根节点的步数
+    '''
+    if MATE_LOWER <= score < MATE_UPPER:
+        return score - ply
+    if -MATE_UPPER < score <= -MATE_LOWER:
+        return score + ply
+    return score
+
+
+class TranspositionTable:
+    '''
+    定长置换表, 以Zobrist键值索引。
+    每个桶两个槽: 槽0深度优先(depth-preferred), 槽1总是替换(always-replace)。
+    每个局面只占一个槽, 上下界只在深度相同时可用。同一局面再次写入时, 本次搜索写入的更深的上下界不会被较浅的结果覆盖
+    (较浅的结果只在原条目没有着法时补上着法); 更深、同样深度或旧搜索留下的条目则直接覆盖。
+    每个条目记录 键值/上下界/深度/是否根节点/最佳着法/年龄, 全部存放在一块预先分配的缓冲区中,
+    长时间对局内存也不会增长, 也不需要像以前那样超过TABLE_SIZE就整张表清空。
+    buffer可以是multiprocessing.shared_memory的缓冲区, 这样多个搜索进程共用一张表(Lazy SMP)。
+    共享的表不加锁, 其他进程可能正写到一半: 每个条目另存一个校验字(键值与其余字段的异或), 读的时候按读到的字段重算,
+    不一致就当作没有这个条目(ENTRY_EMPTY/没有着法)。
+    probes: 查询上下界的次数; hits: 上下界可用(键值、深度、根节点标记都相同且没有过期)的次数; collisions: 桶被其他局面占用导致未命中的次数; overwrites: 覆盖其他局面条目的次数。
+    '''
+
+    # 每个条目的字节数: 键值8 + 校验字8 + 上下界(64位整数)8*2 + 着法2 + 深度/标记/年龄各1
+    ENTRY_BYTES = 37
+
+    def __init__(self, size=TABLE_SIZE, buffer=None):
+        assert size >= 2 and size & (size - 1) == 0, "TABLE_SIZE must be a power of two"
+        self.size = size
+        self.mask = (size >> 1) - 1
+        self.shared = buffer is not None  # 共享的表读写时都要校验
+        self.buffer = bytearray(size * self.ENTRY_BYTES) if buffer is None else buffer
+        n = size
+        self._view = memoryview(self.buffer)[:n * self.ENTRY_BYTES]
+        self.keys = self._view[0:8 * n].cast('Q')
+        self.checks = self._view[8 * n:16 * n].cast('Q')
+        # 分数都是整数, 按整数存, 读出来不会变成浮点数
+        self.lower = self._view[16 * n:24 * n].cast('q')
+        self.upper = self._view[24 * n:32 * n].cast('q')
+        self.moves = self._view[32 * n:34 * n].cast('H')  # i << 8 | j, 0表示没有着法
+        self.depth = self._view[34 * n:35 * n].cast('b')
+        self.flags = self._view[35 * n:36 * n].cast('B')  # bit0: 已使用, bit1: 根节点
+        self.ages = self._view[36 * n:37 * n].cast('B')
+        # 新分配的缓冲区已经全是0; 共享内存的缓冲区可能是其他进程正在用的表, 不能清空
+        self.reset_stats()
+
+    def clear(self):
+        self._view[:] = bytes(len(self._view))
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.age = 0
+        self.score_floor = 0  # 年龄早于score_floor的条目只保留着法, 上下界不再可用
+        self.probes = 0
+        self.hits = 0
+        self.collisions = 0
+        self.overwrites = 0
+
+    def new_search(self, keep_scores=True):
+        '''
+        每回合开始时年龄加一, 旧的条目在替换时优先被淘汰。
+        keep_scores为False时(例如换了根节点或暗子池变了, 上下界的基准随之改变), 旧条目的上下界作废, 着法仍可用于排序。
+        '''
+        self.age = (self.age + 1) & 255
+        if not keep_scores:
+            self.score_floor = self.age
+
+    def _slot(self, key):
+        base = (key & self.mask) << 1
+        keys, flags = self.keys, self.flags
+        if keys[base] == key and flags[base]:
+            return base
+        if keys[base + 1] == key and flags[base + 1]:
+            return base + 1
+        return -1
+
+    def probe(self, key):
+        '''
+        返回key所在的槽位, 没有则返回-1, 同时统计查询/冲突; 命中在get_score确认上下界可用后才统计
+        '''
+        slot = self._slot(key)
+        self.probes += 1
+        if slot < 0:
+            base = (key & self.mask) << 1
+            if self.flags[base] or self.flags[base + 1]:
+                self.collisions += 1
+        return slot
+
+    @staticmethod
+    def _check_word(key, lower, upper, move, depth, flags, age):
+        return (key ^ hash(lower) ^ hash(upper) << 1 ^ move ^ (depth & 255) << 16 ^ flags << 24 ^ age << 32) \
+            & 0xFFFFFFFFFFFFFFFF
+
+    def _seal(self, slot):
+        '''
+        写完一个条目的所有字段后写校验字
+        '''
+        if self.shared:
+            self.checks[slot] = self._check_word(self.keys[slot], self.lower[slot], self.upper[slot], self.moves[slot],
+                                                 self.depth[slot], self.flags[slot], self.ages[slot])
+
+    def _read(self, slot, key):
+        '''
+        读出槽位的 (lower, upper, move, depth, flags, age); 共享的表校验不一致(其他进程正在写)时返回None
+        '''
+        entry = (self.lower[slot], self.upper[slot], self.moves[slot], self.depth[slot], self.flags[slot], self.ages[slot])
+        if self.shared and self.checks[slot] != self._check_word(key, *entry):
+            return None
+        return entry
+
+    def get_move(self, key):
+        slot = self._slot(key)
+        if slot < 0:
+            return None
+        entry = self._read(slot, key)
+        if entry is None:
+            return None
+        m = entry[2]
+        return (m >> 8, m & 255) if m else None
+
+    def get_score(self, key, depth, root):
+        '''
+        只有深度和根节点标记都相同时上下界才可用, 与原先 tp_score[pos, depth, root] 的语义一致
+        '''
+        slot = self.probe(key)
+        if slot < 0:
+            return ENTRY_EMPTY
+        entry = self._read(slot, key)
+        if entry is None:
+            return ENTRY_EMPTY
+        lower, upper, _, entry_depth, flags, age = entry
+        if entry_depth != depth or bool(flags & 2) != root:
+            return ENTRY_EMPTY
+        if (age - self.score_floor) & 255 > (self.age - self.score_floor) & 255:
+            return ENTRY_EMPTY
+        self.hits += 1
+        return Entry(lower, upper)
+
+    def _replace(self, key, depth):
+        '''
+        为新局面挑选槽位: 槽0的条目更深且是本次搜索的, 就写入槽1; 否则槽0降级到槽1, 新条目写入槽0
+        '''
+        base = (key & self.mask) << 1
+        flags = self.flags
+        if flags[base] and self.ages[base] == self.age and self.depth[base] > depth:
+            slot = base + 1
+        else:
+            slot = base
+            if flags[base]:
+                if flags[base + 1]:
+                    self.overwrites += 1
+                for arr in (self.keys, self.lower, self.upper, self.depth, self.flags, self.moves, self.ages, self.checks):
+                    arr[base + 1] = arr[base]
+                return slot
+        if flags[slot]:
+            self.overwrites += 1
+        return slot
+
+    def store(self, key, depth, root, lower, upper, move=None):
+        slot = self._slot(key)
+        if slot < 0:
+            slot = self._replace(key, depth)
+            self.keys[slot] = key
+            self.moves[slot] = 0
+        elif self.ages[slot] == self.age and self.depth[slot] > depth:
+            # 本次搜索已有更深的结果, 保留它的上下界和着法
+            if move is not None and not self.moves[slot]:
+                self.moves[slot] = move[0] << 8 | move[1]
+                self._seal(slot)
+            return
+        self.lower[slot] = lower
+        self.upper[slot] = upper
+        self.depth[slot] = depth
+        self.flags[slot] = 3 if root else 1
+        self.ages[slot] = self.age
+        if move is not None:
+            self.moves[slot] = move[0] << 8 | move[1]
+        self._seal(slot)
+
+    def store_move(self, key, move):
+        '''
+        只记录着法(吃将等提前返回的情况), 不提供可用的上下界
+        '''
+        slot = self._slot(key)
+        if slot < 0:
+            self.store(key, -1, False, -MATE_UPPER, MATE_UPPER, move)
+        else:
+            self.moves[slot] = move[0] << 8 | move[1]
+            self.ages[slot] = self.age
+            self._seal(slot)
+
+    def hashfull(self):
+        '''
+        置换表占用的千分比: 抽查前1000个槽位中本次搜索写入的条目数
+        '''
+        n = min(1000, 2 * self.size)
+        flags, ages, age = self.flags, self.ages, self.age
+        used = sum(1 for slot in range(n) if flags[slot] and ages[slot] == age)
+        return used * 1000 // n
+
+    def release(self):
+        '''
+        释放对缓冲区的引用, 之后才能关闭共享内存
+        '''
+        for view in (self.keys, self.checks, self.lower, self.upper, self.moves, self.depth, self.flags, self.ages,
+                     self._view):
+            view.release()
+
+
+def _release_shared_table(tp, shm):
+    tp.release()
+    shm.close()
+    shm.unlink()
+
+
+def _smp_worker(k, state, shm_name, size, generation, time_limit, max_depth, results, stop):
+    '''
+    Lazy SMP的辅助搜索进程: 与主进程共用置换表, 迭代加深的起始深度和根节点着法顺序错开,
+    每完成一层就把 (k, depth, move, score, nodes) 放进results, 结束时放 (k, None, None, None, nodes)
+    '''
+    global di, sumall, forbidden_moves
+    board, score, turn, version, di, sumall, forbidden_moves = state
+    sys.stdout = open(os.devnull, 'w')
+    # 子进程与主进程共用同一个resource_tracker, 共享内存只由主进程unlink
+    shm = shared_memory.SharedMemory(name=shm_name)
+    tp = TranspositionTable(size, shm.buf)
+    tp.age, tp.score_floor = generation
+    searcher = Searcher(tp=tp, workers=1, split_workers=1)
+    searcher.root_shift = k // 2
+    try:
+        pos = Position(board, score, turn, version).set()
+        tm = TimeManager(time_limit, time_limit)
+        for info in searcher.search_serial(pos, (), tm, max_depth, min_depth=MIN_DEPTH + k % 2,
+                                           limits=SearchLimits(stop=stop)):
+            results.put((k, info.depth, info.move, info.score, searcher.nodes))
+    finally:
+        results.put((k, None, None, None, searcher.nodes))
+        tp.release()
+        shm.close()
+
+
+_split_searcher = None
+_split_alpha = None
+_split_stop = None
+_split_state = None
+
+
+def _split_init(alpha, stop):
+    global _split_searcher, _split_alpha, _split_stop
+    sys.stdout = open(os.devnull, 'w')
+    _split_searcher = Searcher(workers=1, split_workers=1)
+    _split_alpha, _split_stop = alpha, stop
+
+
+def _split_probe(state, generation, board, score, turn, version, move, alpha, beta, depth, deadline, nullmove,
+                 node_limit=0, max_depth=None):
+    '''
+    根节点分割搜索的工作进程任务: 走完根节点的一步move之后, 以共享的当前alpha做PVS窄窗搜索, 窄窗失败高时再做全窗搜索。
+    node_limit是这个任务的节点数份额(0表示不限), max_depth是主进程SearchLimits的最大深度。
+    返回 (move, 分数, 节点数); 超时、用完节点数份额或被主进程叫停时分数为None。
+    每个工作进程保留自己的置换表, 同一次搜索的后续任务可以复用。
+    '''
+    global di, sumall, forbidden_moves, _split_state
+    searcher = _split_searcher
+    if state != _split_state:
+        di, sumall, forbidden_moves = state
+        _split_state = state
+        searcher.calc_average()
+    if searcher.tp.age != generation[0]:
+        searcher.age_history()
+    searcher.tp.age, searcher.tp.score_floor = generation
+    searcher.nodes = 0
+    searcher.limits = SearchLimits(nodes=node_limit, depth=max_depth, stop=_split_stop)
+    searcher.limits.retime(TimeManager(deadline - time.time()))
+    searcher.limits.reset()
+    if max_depth is not None:
+        depth = min(depth, max_depth)
+    alpha = max(alpha, _split_alpha.value)
+    pos = MutablePosition(Position(board, score, turn, version).set()) if MAKE_UNMAKE \
+        else PositionStack(Position(board, score, turn, version).set())
+    pos.make(move)
+    try:
+        val = -searcher.alphabeta(pos, -alpha - 1, -alpha, depth - 1,
+                                  root=False, nullmove=nullmove, nullmove_now=nullmove)
+        if alpha < val < beta:
+            val = -searcher.alphabeta(pos, -beta, -alpha, depth - 1,
+                                      root=False, nullmove=nullmove, nullmove_now=nullmove)
+    except TimeoutError:
+        val = None
+    return move, val, searcher.nodes
+
+
+def _shutdown_pool(pool):
+    pool.shutdown(wait=True, cancel_futures=True)
+
+
+class TimeManager:
+    '''
+    一步棋的用时管理。hard是硬限制, 到时alphabeta里的超时检查中断搜索; soft是软限制, 用时超过soft后不再开始新的一层。
+    每完成一层调用done(): 用相邻两层的用时之比估计有效分支因子, 预测下一层的用时, 在hard之前完成不了就不开始,
+    不再把时间浪费在超时后被丢弃的半层上。最佳着法在相邻两层之间变化时局面还不稳定, soft延长TIME_UNSTABLE_EXTEND倍(不超过hard)。
+    '''
+
+    def __init__(self, hard, soft=None):
+        self.set_limits(hard, soft)
+        self.iteration_start = self.start
+        self.last_time = 0.0
+        self.ebf = 0.0
+        self.last_move = None
+
+    @classmethod
+    def from_clock(cls, remaining, increment=0.0, moves_to_go=0):
+        '''
+        按棋钟分配(秒): 剩余时间平均分给还要走的步数再加上每步加秒作为软限制, 硬限制是它的1/TIME_SOFT_RATIO倍,
+        但不超过剩余时间的TIME_CLOCK_MAX_SHARE, 也不低于TIME_MIN_HARD
+        '''
+        target = remaining / (moves_to_go or TIME_MOVES_TO_GO) + increment
+        hard = max(TIME_MIN_HARD, min(target / TIME_SOFT_RATIO, remaining * TIME_CLOCK_MAX_SHARE))
+        return cls(hard, max(0.0, min(target, hard)))
+
+    def set_limits(self, hard, soft=None):
+        '''
+        从现在起按新的限制计时, 已经统计的每层用时保留(后台思考猜中时用)
+        '''
+        self.start = time.time()
+        self.hard = hard
+        self.soft = hard * TIME_SOFT_RATIO if soft is None else soft
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def done(self, move):
+        '''
+        完成了一层, 最佳着法为move。返回是否开始下一层
+        '''
+        now = time.time()
+        spent = now - self.iteration_start
+        self.iteration_start = now
+        if self.last_time > 0.001:
+            ebf = spent / self.last_time
+            self.ebf = ebf if not self.ebf else (self.ebf + ebf) / 2
+        self.last_time = spent
+        if self.last_move is not None and move != self.last_move:
+            self.soft = min(self.soft * TIME_UNSTABLE_EXTEND, self.hard)
+        self.last_move = move
+        elapsed = now - self.start
+        if elapsed >= self.soft:
+            return False
+        return not (self.ebf and elapsed + spent * self.ebf > self.hard)
+
+
+class SearchLimits:
+    '''
+    一次搜索的停止条件: 节点数上限nodes(0表示不限)、最大深度depth(None表示MAX_DEPTH)、用时和外部停止信号stop。
+    用时由TimeManager的硬限制给出(retime)。stop可以是threading.Event/multiprocessing.Event,
+    也可以是共享内存里的一个字节(bytearray、memoryview、multiprocessing.Value等), 非0表示停止。
+    alphabeta和静态搜索在节点数到达next_check时调用expired(): 到达任一限制就抛出TimeoutError中断搜索。
+    检查的间隔按实测的NPS调整, 约每LIMITS_CHECK_PERIOD秒一次; 有节点数上限时正好在上限处检查, 定节点数的搜索结果可以复现。
+    '''
+
+    def __init__(self, nodes=0, depth=None, stop=None):
+        self.nodes = nodes
+        self.depth = depth
+        self.stop = stop
+        self.start = time.time()
+        self.hard = float('inf')
+        self.next_check = LIMITS_CHECK_MIN
+        self._checked = (self.start, 0)
+
+    def retime(self, manager):
+        '''
+        按manager(TimeManager)的起点和硬限制计时。先改起点再改时长, 搜索进行中调用也不会误判超时。
+        '''
+        self.start = manager.start
+        self.hard = manager.hard
+
+    def reset(self, nodes=0):
+        '''
+        搜索开始(节点计数为nodes)时调用, 重新测量NPS
+        '''
+        self._checked = (time.time(), nodes)
+        self.next_check = nodes + LIMITS_CHECK_MIN
+        if self.nodes:
+            self.next_check = min(self.next_check, self.nodes)
+
+    def stopped(self):
+        stop = self.stop
+        if stop is None:
+            return False
+        if hasattr(stop, 'is_set'):
+            return stop.is_set()
+        if hasattr(stop, 'value'):
+            return bool(stop.value)
+        return bool(stop[0])
+
+    def expired(self, nodes):
+        '''
+        节点计数为nodes时检查: 到达任一限制返回True, 否则按上次检查以来的NPS定下一次检查的节点数
+        '''
+        now = time.time()
+        if now - self.start > self.hard or self.stopped() or (self.nodes and nodes >= self.nodes):
+            return True
+        last_time, last_nodes = self._checked
+        if now > last_time:
+            interval = int((nodes - last_nodes) / (now - last_time) * LIMITS_CHECK_PERIOD)
+        else:
+            interval = 2 * (nodes - last_nodes)
+        self._checked = (now, nodes)
+        self.next_check = nodes + max(LIMITS_CHECK_MIN, min(interval, LIMITS_CHECK_MAX))
+        if self.nodes:
+            self.next_check = min(self.next_check, self.nodes)
+        return False
 
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = {}
-        self.tp_move = {}
+    def __init__(self, tp=None, workers=None, split_workers=None):
+        '''
+        tp: 外部传入的(共享)置换表, 此时search不会清空它
+        workers: 并行搜索的进程数, 默认SMP_WORKERS
+        split_workers: 根节点分割搜索的进程数, 默认ROOT_SPLIT_WORKERS
+        '''
+        self.tp = TranspositionTable() if tp is None else tp
+        self.shared_tp = tp is not None
+        self.workers = SMP_WORKERS if workers is None else workers
+        self.split_workers = ROOT_SPLIT_WORKERS if split_workers is None else split_workers
+        self._pool = None
         self.history = set()
         self.nodes = 0
-        self.start_time = 0.0
-        self.time_limit = 0.0
+        self.seldepth = 0  # 本次搜索到达的最大层数(含静态搜索)
+        self.limits = SearchLimits()  # 当前搜索的停止条件: 用时、节点数、深度和外部停止信号
+        self.quiet = False  # 后台思考时不打印
+        self.time_manager = None  # 当前搜索的TimeManager
+        self.root_shift = 0  # 根节点着法顺序的错开量, 仅Lazy SMP的辅助进程使用
+        # 根节点最近一次搜索里每个已搜完着法的分数, 以及这次搜索的alpha; 超时时用来挑出这一层已经证明更好的着法
+        self.root_scores = {}
+        self.root_alpha = -MATE_UPPER
+        self.fail_high = None
+        # 每层的杀手着法, 以及按(起点, 终点)索引的历史表(butterfly history), 下标为 i << 8 | j
+        self.killers = [[] for _ in range(MAX_PLY)]
+        self.butterfly = [0] * 65536
+        self._signature = None
+        self._forbidden = set()
+        self._shm = None
+
+    def quiescence(self, pos, alpha, beta):
+        '''
+        静态搜索: 只搜吃子着法的递归alpha-beta。
+        站着不动(stand pat)的分数是当前局面分加上空头炮分; 吃子价值加上QS_DELTA_MARGIN仍不到alpha的吃子不搜(delta剪枝),
+        静态交换评估为负的吃子也不搜。吃子着法和交换评估都来自本节点的攻击表(AttackMap), 每个节点只扫描一次棋盘。
+        '''
+        self.nodes += 1
+        if self.nodes >= self.limits.next_check and self.limits.expired(self.nodes):
+            raise TimeoutError
+        ply = pos.ply
+        if ply > self.seldepth:
+            self.seldepth = ply
+        if pos.score <= -MATE_LOWER:
+            return -MATE_UPPER
 
-    def quiescence(self, pos, moves, oppo):
-        maxscore = 0
-        argmax = None
-    
-        oppo_rooted_set = oppo.rooted()
-        oppo_rooted_set = {254-x for x in oppo_rooted_set}
-    
-        board = pos.board
-        pst_local = pst
-        avg = average
-    
-        for i, j in moves:
-            q = board[j]
-            if q == '.':
+        amap = pos.attack_map()
+        captures = amap.captures()
+        if captures and pos.board[captures[0][1]] == 'k':
+            return MATE_UPPER
+
+        stand = best = pos.score + pos.kongtou_score - pos.kongtou_score_opponent
+        if best >= beta:
+            return best
+        alpha = max(alpha, best)
+        value = amap.piece_value
+        for move in captures:
+            victim = value(move[1])
+            if stand + victim + QS_DELTA_MARGIN <= alpha:
                 continue
-    
-            p = board[i]
-            if p == 'D':
-                if q == 'r' and 240 > maxscore:
-                    argmax = (i, j)
-                    maxscore = 240
+            # 用不比被吃子贵的子去吃, 交换下来不会亏, 不必做交换评估
+            if value(move[0]) > victim and amap.see(move) < 0:
                 continue
-    
-            s = 0  # ★每个 move 重置
-    
-            k = 254 - j
-            if q in 'rcnabpk':
-                s += pst_local[q.upper()][k]
-            elif q in 'defghi':
-                s += avg[oppo.version][oppo.turn][False]
-            elif q == 'u':
-                s += avg[oppo.version][oppo.turn][True][k]
-    
-            if j in oppo_rooted_set:
-                if p in 'RCNABPK':
-                    s -= pst_local[p][j]
-                elif p in 'EFGHI':
-                    s -= avg[pos.version][pos.turn][False]
-    
-            if s > maxscore:
-                argmax = (i, j)
-                maxscore = s
-    
-        if argmax and board[argmax[1]] == 'c' and (argmax[1] & 15) == 7 and pos.kongtou_score_opponent > 0 and pos.kongtoupao_opponent > 0:
-            pos.kongtou_score_opponent = 0
-    
-        return maxscore, argmax
-    
-
+            pos.make(move)
+            val = -self.quiescence(pos, -beta, -alpha)
+            pos.unmake()
+            if val > best:
+                best = val
+                if val >= beta:
+                    break
+                if val > alpha:
+                    alpha = val
+        return best
 
     def alphabeta(self, pos, alpha, beta, depth, root=True, nullmove=False, nullmove_now=False):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         global debug_var
+        # 深度用完后直接进入静态搜索, 吃将的判断也在静态搜索里
+        if depth <= 0 and QS and not root:
+            return self.quiescence(pos, alpha, beta)
         alpha0, beta0 = alpha, beta
-        oppo = None
-        def get_oppo():
-            nonlocal oppo
-            if oppo is None:
-                oppo = pos.rotate()
-            return oppo
-        if root:
-            self.tp_score = {}
-            self.tp_move = {}
         self.nodes += 1
-        #  每 1024 个节点检查一次时间
-        if (self.nodes & 1023) == 0:
-            if time.time() - self.start_time > self.time_limit:
-                raise TimeoutError
+        #  按SearchLimits定的间隔检查用时、节点数和停止信号
+        if self.nodes >= self.limits.next_check and self.limits.expired(self.nodes):
+            raise TimeoutError
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
@@ -939,39 +2098,65 @@ class Searcher:
         if pos.score <= -MATE_LOWER:
             return -MATE_UPPER
 
-        moves = sorted(pos.gen_moves(), key=pos.value, reverse=True)
-        killer = self.tp_move.get(pos)
-        for move in [killer] + moves:
-            if (move is not None) and pos.board[move[1]] == 'k':
-                self.tp_move[pos] = move
+        # 着法只生成不排序, 排序由pick_moves分阶段按需进行
+        moves = list(pos.gen_moves())
+        key = pos.zobrist_hash
+        for move in moves:
+            if pos.board[move[1]] == 'k':
+                self.tp.store_move(key, move)
                 return MATE_UPPER
+        killer = self.tp.get_move(key)
+        if self.shared_tp and killer not in moves:
+            # 共享置换表不加锁, 其他进程同时写入时可能读到不一致的条目
+            killer = None
+
+        # 将军延伸: 在置换表查询之前调整深度, 保证存取的深度一致
+        ply = pos.ply
+        if ply > self.seldepth:
+            self.seldepth = ply
+        if ply >= MAX_PLY:
+            # 空着和将军延伸叠加出的过深变例: 杀手着法表到头了, 按静态分数返回
+            return pos.score + pos.kongtou_score - pos.kongtou_score_opponent
+        # 将军状态在将军延伸和LMR(被将军时不缩减)都要用, 与CHECK_EXTENSION是否打开无关
+        in_check = None
+        if (CHECK_EXTENSION or LMR) and depth > 0 and not root:
+            in_check = self.in_check(pos)
+            if in_check and CHECK_EXTENSION and ply < MAX_PLY - 1:
+                depth += CHECK_EXTENSION
 
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= beta and (not root or self.tp_move.get(pos) is not None):
+        entry = self.tp.get_score(key, depth, root)
+        if entry is not ENTRY_EMPTY:
+            entry = Entry(mate_from_tt(entry.lower, ply), mate_from_tt(entry.upper, ply))
+        if entry.lower >= beta and (not root or killer is not None):
             return entry.lower
         if entry.upper < alpha:
             return entry.upper
 
-        if nullmove_now and depth > 3 and not root and any(c in pos.board for c in 'RNCI'):
-            opp = get_oppo()
-            if all(opp.board[m[1]] != 'k' for m in opp.gen_moves()):
-               val = -self.alphabeta(pos.rotate(), -beta, 1-beta, depth-3, root=False, nullmove=nullmove, nullmove_now=False)
-               if val >= beta and self.alphabeta(pos, alpha, beta, depth-3, root=False, nullmove=nullmove, nullmove_now=False):
-                  return val
+        if nullmove_now and depth > 3 and not root and any(c in pos.board for c in 'RNCI') and not (
+                self.in_check(pos) if in_check is None else in_check):
+            pos.make_null()
+            val = -self.alphabeta(pos, -beta, 1-beta, depth-3, root=False, nullmove=nullmove, nullmove_now=False)
+            pos.unmake()
+            if val >= beta and self.alphabeta(pos, alpha, beta, depth-3, root=False, nullmove=nullmove, nullmove_now=False):
+                return val
 
         nullmove_now = nullmove
 
         # For QSearch we have a different kind of null-move, namely we can just stop
         # and not capture anything else.
         if depth == 0:
-            if QS:
-                score = self.quiescence(pos, moves, get_oppo())
-                return pos.score + pos.kongtou_score - pos.kongtou_score_opponent + score[0]
-            else:
+            return pos.score + pos.kongtou_score - pos.kongtou_score_opponent
+
+        # 去掉送将的着法; 没有合法着法就是被将死或困毙, 象棋规则里困毙也算负, 按离根节点的步数给杀棋分数
+        moves = pos.legal_moves(moves, in_check)
+        if not moves:
+            if 'U' in pos.board and not (self.in_check(pos) if in_check is None else in_check):
+                # 搜索中翻开的暗子是不确定子U, 不能走; 实际对局里它能走, 不算困毙, 按静态分数返回
                 return pos.score + pos.kongtou_score - pos.kongtou_score_opponent
+            return -(MATE_UPPER - ply)
 
         # Then killer move. We search it twice, but the tp will fix things for us.
         # Note, we don't have to check for legality, since we've already done it
@@ -981,178 +2166,587 @@ class Searcher:
 
         # Then all the other moves
         mvBest = None
-
-        for move in [killer] + moves:
+        first = None
+        # 根节点分割: 第一步全窗搜索之后, 其余着法交给进程池做PVS窄窗搜索
+        split = root and self.split_workers > 1 and depth >= ROOT_SPLIT_MIN_DEPTH
+        rest = []
+
+        killers = self.killers[ply]
+        picker = self.pick_moves(pos, moves, killer, killers)
+        reductions = lmr_table[min(depth, MAX_PLY - 1)] if LMR and not in_check and not root else None
+        searched = 0
+        if root:
+            self.root_scores = {}
+            self.root_alpha = alpha
+            # 根节点的着法顺序在搜索前一次排好, 不随搜索中历史分的变化而变; 根节点分割时同分按这个顺序取舍, 与串行搜索一致
+            picker = list(picker)
+        if root and self.root_shift and moves:
+            # Lazy SMP: 辅助进程错开根节点着法顺序(置换表着法仍然最先), 各进程优先搜索不同的分支
+            head = 1 if killer is not None else 0
+            shift = head + self.root_shift % (len(picker) - head or 1)
+            picker = picker[:head] + picker[shift:] + picker[head:shift]
+
+        for move in picker:
+            if first is None:
+                first = move
             if root and move in forbidden_moves:
                 continue
-            if move is None:
+            if split and best > -MATE_UPPER:
+                if move not in rest:
+                    rest.append(move)
                 continue
         
-            child = pos.move(move)  # 只做一次
+            # 不吃子、不是置换表着法或杀手着法、走完不将军的着法才做缩减(翻暗子的着法也可以缩减)
+            r = 0
+            if reductions is not None and best > -MATE_UPPER and move != killer and move not in killers \
+                    and pos.board[move[1]] == '.':
+                r = reductions[min(searched, 255)]
+            searched += 1
+
+            pos.make(move)  # 只做一次
+            if r and self.in_check(pos):
+                r = 0  # 将军的着法不缩减
         
             if best == -MATE_UPPER:
-                val = -self.alphabeta(child, -beta, -alpha, depth - 1,
+                val = -self.alphabeta(pos, -beta, -alpha, depth - 1,
                                       root=False, nullmove=nullmove, nullmove_now=nullmove_now)
             else:
-                # PVS 窄窗
-                val = -self.alphabeta(child, -alpha - 1, -alpha, depth - 1,
+                # PVS 窄窗, LMR时先降低深度
+                val = -self.alphabeta(pos, -alpha - 1, -alpha, depth - 1 - r,
                                       root=False, nullmove=nullmove, nullmove_now=nullmove_now)
+                if r and val > alpha:
+                    val = -self.alphabeta(pos, -alpha - 1, -alpha, depth - 1,
+                                          root=False, nullmove=nullmove, nullmove_now=nullmove_now)
                 if alpha < val < beta:
                     # 需要时再全窗
-                    val = -self.alphabeta(child, -beta, -alpha, depth - 1,
+                    val = -self.alphabeta(pos, -beta, -alpha, depth - 1,
                                           root=False, nullmove=nullmove, nullmove_now=nullmove_now)
         
-            if val >= MATE_UPPER:
-                updated = child.nullmove()  # 复用 child
-                if any(updated.board[m[1]] == 'k' for m in updated.gen_moves()):
-                    mvBest = move
-                    best = val
-                    break
+            pos.unmake()
+            if root:
+                self.root_scores[move] = val
         
             if val > best and val > -MATE_UPPER:
                 best = val
                 mvBest = move
                 if val > beta:
+                    if pos.board[move[1]] == '.':
+                        self.update_killers(ply, move, depth)
                     break
                 if val > alpha:
                     alpha = val
 
+        if rest and best <= beta:
+            best, mvBest = self.root_split(pos, rest, best, mvBest, alpha, beta, depth, nullmove)
                         
         if not mvBest and moves:
-            mvBest = moves[0]
-
-        if mvBest is not None:
-            # Clear before setting, so we always have a value
-            # Save the move for pv construction and killer heuristic
-            if len(self.tp_move) > TABLE_SIZE: self.tp_move.clear()
-            self.tp_move[pos] = mvBest
-
-        # Stalemate checking is a bit tricky: Say we failed low, because
-        # we can't (legally) move and so the (real) score is -infty.
-        # At the next depth we are allowed to just return r, -infty <= r < gamma,
-        # which is normally fine.
-        # However, what if gamma = -10 and we don't have any legal moves?
-        # Then the score is actaully a draw and we should fail high!
-        # Thus, if best < gamma and best < 0 we need to double check what we are doing.
-        # This doesn't prevent sunfish from making a move that results in stalemate,
-        # but only if depth == 1, so that's probably fair enough.
-        # (Btw, at depth 1 we can also mate without realizing.)
-        if best < alpha and best < 0 and depth > 0:
-            is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
-            if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
-                in_check = is_dead(pos.nullmove())
-                best = -MATE_UPPER if in_check else 0
-
-        # Clear before setting, so we always have a value
-        if len(self.tp_score) > TABLE_SIZE: self.tp_score.clear()
+            mvBest = first
+
         # Table part 2
+        # Save the move for pv construction and killer heuristic
+        stored = mate_to_tt(best, ply)
         if best >= beta0:
-            self.tp_score[pos, depth, root] = Entry(best, entry.upper)
+            self.tp.store(key, depth, root, stored, mate_to_tt(entry.upper, ply), mvBest)
         elif best <= alpha0:
-            self.tp_score[pos, depth, root] = Entry(entry.lower, best)
+            self.tp.store(key, depth, root, mate_to_tt(entry.lower, ply), stored, mvBest)
         else:
             # best 落在窗口内：精确值
-            self.tp_score[pos, depth, root] = Entry(best, best)
+            self.tp.store(key, depth, root, stored, stored, mvBest)
 
         return best
 
-    def search(self, pos, history=(), time_limit=None):
-        """ Iterative deepening MTD-bi search """
+    def in_check(self, pos):
+        '''
+        走子方是否被将军(对方下一步可以吃将)
+        '''
+        return pos.in_check()
+
+    def pick_moves(self, pos, moves, tt_move, killers=()):
+        '''
+        分阶段的着法排序(生成器): 置换表着法 -> 吃子(MVV-LVA) -> 杀手着法 -> 其余着法(按Position.value排序)。
+        每个阶段只在前面的着法没有产生截断、搜索继续取下一步时才计算, 安静着法的value也只在此时才调用。
+        暗子和不确定子的价值按对应一方暗子的平均价值计算。
+        '''
+        if tt_move is not None:
+            yield tt_move
+        board = pos.board
+        covered = average[pos.version][pos.turn][False]
+        covered_opponent = average[pos.version][not pos.turn][False]
+        captures, quiets = [], []
+        for move in moves:
+            if move == tt_move:
+                continue
+            (captures if board[move[1]] != '.' else quiets).append(move)
+        if captures:
+            def mvv_lva(move):
+                p, q = board[move[0]], board[move[1]].upper()
+                return piece.get(q, covered_opponent) * 16 - (piece[p] if p in piece else covered)
+            captures.sort(key=mvv_lva, reverse=True)
+            yield from captures
+        if killers:
+            quiet_set = set(quiets)
+            killers = [move for move in killers if move in quiet_set]
+            yield from killers
+            quiets = [move for move in quiets if move not in killers]
+        butterfly = self.butterfly
+        quiets.sort(key=lambda move: (butterfly[move[0] << 8 | move[1]], pos.value(move)), reverse=True)
+        yield from quiets
+
+    def update_killers(self, ply, move, depth):
+        '''
+        安静着法产生beta截断时调用: 记为本层的杀手着法, 并按深度的平方累加历史分
+        '''
+        killers = self.killers[ply]
+        if move in killers:
+            killers.remove(move)
+        killers.insert(0, move)
+        del killers[KILLER_SLOTS:]
+        self.butterfly[move[0] << 8 | move[1]] += depth * depth
+
+    def age_history(self):
+        '''
+        回合之间: 杀手着法清空, 历史分减半, 让新局面的统计逐渐取代旧的
+        '''
+        self.killers = [[] for _ in range(MAX_PLY)]
+        self.butterfly = [h >> 1 for h in self.butterfly]
+
+    def root_split(self, pos, moves, best, mvBest, alpha, beta, depth, nullmove):
+        '''
+        把根节点剩余的着法分发到进程池搜索, alpha提高时通过共享变量推送给之后开始的任务。
+        同时运行的任务不超过进程数; 有节点数上限时, 每个任务开始时把剩余的节点数平分给各进程作为它的份额,
+        任务用完份额就按到达上限处理, 总节点数不超过上限。最大深度也传给任务。
+        返回 (best, mvBest), 与串行循环的结果含义相同; 超时则叫停所有任务并抛出TimeoutError。
+        同分时按moves的顺序(即串行搜索的顺序)取靠前的着法, 第一步(置换表着法)不在moves里, 同分时总是保留它。
+        '''
+        if self._pool is None:
+            ctx = multiprocessing.get_context()
+            self._split_alpha, self._split_stop = ctx.Value('d', 0.0, lock=False), ctx.Event()
+            self._pool = ProcessPoolExecutor(self.split_workers, mp_context=ctx, initializer=_split_init,
+                                             initargs=(self._split_alpha, self._split_stop))
+            weakref.finalize(self, _shutdown_pool, self._pool)
+        self._split_alpha.value = alpha
+        self._split_stop.clear()
+        state = (di, sumall, forbidden_moves)
+        board = ''.join(pos.board)
+        deadline = self.limits.start + self.limits.hard
+        order = {move: n for n, move in enumerate(moves)}
+        generation = (self.tp.age, self.tp.score_floor)
+        queue = iter(moves)
+        futures = set()
+
+        def submit():
+            move = next(queue, None)
+            if move is None:
+                return set()
+            node_limit = 0
+            if self.limits.nodes:
+                node_limit = max(LIMITS_CHECK_MIN, (self.limits.nodes - self.nodes) // self.split_workers)
+            future = self._pool.submit(_split_probe, state, generation, board, pos.score, pos.turn, pos.version,
+                                       move, alpha, beta, depth, deadline, nullmove, node_limit, self.limits.depth)
+            futures.add(future)
+            return {future}
+
+        pending = set()
+        for _ in range(self.split_workers):
+            pending |= submit()
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    move, val, nodes = future.result()
+                    self.nodes += nodes
+                    if val is None:
+                        raise TimeoutError
+                    self.root_scores[move] = val
+                    if val > -MATE_UPPER and val == best and mvBest in order and order[move] < order[mvBest]:
+                        # 同分只是窄窗失败低的上界, 不能说明这步一样好。串行搜索里顺序靠前的着法先搜, 同分时留下的是它,
+                        # 所以在这里用(best - 1, beta)的窗口重搜, 证明它不比当前最佳差才替换
+                        pos.make(move)
+                        try:
+                            val = -self.alphabeta(pos, -beta, 1 - best, depth - 1,
+                                                  root=False, nullmove=nullmove, nullmove_now=nullmove)
+                        finally:
+                            pos.unmake()
+                        self.root_scores[move] = val
+                        if val == best:
+                            mvBest = move
+                    if val > -MATE_UPPER and val > best:
+                        best, mvBest = val, move
+                        if val > beta:
+                            return best, mvBest
+                        if val > alpha:
+                            alpha = val
+                            self._split_alpha.value = alpha
+                    pending |= submit()
+                if self.limits.expired(self.nodes):
+                    raise TimeoutError
+            return best, mvBest
+        finally:
+            # 提前返回或超时时叫停仍在运行的任务, 等它们退出后再开始下一次分发
+            self._split_stop.set()
+            for future in pending:
+                future.cancel()
+            wait(futures)
+
+    def principal_variation(self, pos, limit=MAX_PLY):
+        '''
+        从置换表里的最佳着法重建主要变例: 沿着法走下去, 遇到没有着法、着法不合法或局面重复时停止。
+        pos是MutablePosition/PositionStack, 走过的着法会全部退回。不在搜索的循环里记录, 不增加搜索的开销。
+        '''
+        pv = []
+        seen = set()
+        try:
+            while len(pv) < limit and pos.zobrist_hash not in seen:
+                seen.add(pos.zobrist_hash)
+                move = self.tp.get_move(pos.zobrist_hash)
+                if move is None or move not in pos.legal_moves():
+                    break
+                pv.append(move)
+                pos.make(move)
+        finally:
+            for _ in pv:
+                pos.unmake()
+        return tuple(pv)
+
+    def info(self, depth, move, score, pv, researches=0):
+        '''
+        生成一层搜索结束时的SearchInfo
+        '''
+        used = time.time() - self.limits.start
+        return SearchInfo(depth, move, score, self.seldepth, self.nodes, int(self.nodes / max(used, 1e-9)),
+                          used, self.tp.hashfull(), pv, researches)
+
+    def partial_result(self, pos, depth, last):
+        '''
+        第depth层超时中断时, 从根节点已经搜完的着法里找出比上一层最佳着法(last)更好的着法, 返回它的SearchInfo, 没有则返回None。
+        上一层的最佳着法作为置换表着法在这一层最先搜索; 之后搜完的着法分数超过它和根节点的alpha, 就是这一层证明过的更好着法。
+        分数不超过alpha的是上界(fail-soft), 不能作比较。
+        期望窗口失败高后重搜被中断时, 重搜还没搜到失败高的着法, 就用失败高那一遍(self.fail_high)证明的结果。
+        超时时根节点还停在被中断的变例里, 主要变例从pos重新建一个根节点来走。返回的SearchInfo标记partial。
+        '''
+        scores = self.root_scores
+        move = self.better_move(scores, self.root_alpha, last)
+        if move is None and self.fail_high is not None:
+            proven, alpha = self.fail_high
+            candidate = self.better_move(proven, alpha, last)
+            if candidate is not None and candidate not in scores:
+                scores, move = proven, candidate
+        if move is None:
+            return None
+        root = MutablePosition(pos) if MAKE_UNMAKE else PositionStack(pos)
+        root.make(move)
+        pv = (move,) + self.principal_variation(root, depth - 1)
+        return self.info(depth, move, scores[move], pv)._replace(partial=True)
+
+    @staticmethod
+    def better_move(scores, alpha, last):
+        '''
+        根节点一遍搜索的分数scores(根节点窗口下界为alpha)中证明比上一层最佳着法(last)更好的着法, 没有则返回None
+        '''
+        if last is not None and last.move not in scores:
+            return None
+        baseline = alpha if last is None else max(scores[last.move], alpha)
+        move = max(scores, key=scores.get, default=None)
+        if move is None or scores[move] <= baseline or (last is not None and move == last.move):
+            return None
+        return move
+
+    def retime(self, manager):
+        '''
+        manager的限制在搜索进行中改变了(后台思考猜中): 按新的硬限制重设超时检查
+        '''
+        self.limits.retime(manager)
+
+    def search(self, pos, history=(), time_limit=None, max_depth=None, limits=None):
+        """ Iterative deepening MTD-bi search
+        time_limit: 秒数或TimeManager, 默认THINK_TIME; 秒数按TimeManager(time_limit)管理, 即用时过半后不再开始新的一层。
+        max_depth: 最大搜索深度, 默认按limits.depth, 再默认MAX_DEPTH。基准测试时配合很大的time_limit做定深搜索。
+        limits: SearchLimits, 给出节点数上限、最大深度和外部停止信号; 默认只按用时停止。
+        workers > 1 时使用多进程的Lazy SMP搜索。
+        每完成一层 yield 一个SearchInfo, 其中researches为该层期望窗口失败后重搜的次数。
+        """
+        if self.workers > 1:
+            return self.search_smp(pos, history, time_limit, max_depth, limits)
+        return self.search_serial(pos, history, time_limit, max_depth, limits=limits)
+
+    def new_search(self, pos):
+        '''
+        每次搜索开始时调用, pos是搜索的根节点。PERSISTENT_TT时置换表保留之前的条目, 否则清空。
+        上下界里含有从根节点一路累加的value()奖励(见calc_zobrist的说明), 而每次搜索都以score_rough为根节点的分数重新起算,
+        所以只有根节点和暗子池都没变(例如同一局面再搜一次)时才沿用上下界; 换了根节点(对手应着后)旧条目只保留着法, 用于排序。
+        禁着只限制根节点的着法, 变了只作废根节点的条目。
+        '''
+        signature = repr((pos.zobrist_hash, di, sumall))
+        self.age_history()
+        if PERSISTENT_TT:
+            keep = signature == self._signature
+            self.tp.new_search(keep_scores=keep)
+            if keep and forbidden_moves != self._forbidden:
+                # 深度-1的条目上下界不可用, 着法保留
+                self.tp.store(pos.zobrist_hash, -1, True, -MATE_UPPER, MATE_UPPER)
+        else:
+            self.tp.clear()
+        self._signature = signature
+        self._forbidden = set(forbidden_moves)
+
+    def search_smp(self, pos, history=(), time_limit=None, max_depth=None, limits=None):
+        '''
+        Lazy SMP: 主进程和 workers-1 个辅助进程在同一局面上各自迭代加深, 通过共享内存中的置换表交换结果。
+        辅助进程的起始深度和根节点着法顺序错开; 主进程结束(完成或超时)后通知辅助进程停止,
+        返回所有进程中完成的最深一层的结果。外部停止信号(limits.stop)只由主进程检查, 主进程停下后再通知辅助进程。
+        '''
+        if self._shm is None:
+            size = self.tp.size
+            self._shm = shared_memory.SharedMemory(create=True, size=size * TranspositionTable.ENTRY_BYTES)
+            self.tp = TranspositionTable(size, self._shm.buf)
+            weakref.finalize(self, _release_shared_table, self.tp, self._shm)
+        self.shared_tp = True
+        self.calc_average()
+        pos.set()
+        self.new_search(pos)
+
+        ctx = multiprocessing.get_context()
+        results, stop = ctx.Queue(), ctx.Event()
+        if max_depth is None and limits is not None:
+            max_depth = limits.depth
+        tm = time_limit if isinstance(time_limit, TimeManager) else TimeManager(
+            THINK_TIME if time_limit is None else float(time_limit))
+        state = (pos.board, pos.score, pos.turn, pos.version, di, sumall, forbidden_moves)
+        # 辅助进程只按硬限制计时, 由主进程决定何时停止
+        helpers = [ctx.Process(target=_smp_worker, daemon=True,
+                               args=(k, state, self._shm.name, self.tp.size, (self.tp.age, self.tp.score_floor),
+                                     tm.hard, max_depth, results, stop))
+                   for k in range(1, self.workers)]
+        for p in helpers:
+            p.start()
+
+        best = SearchInfo(0, None, 0, 0, 0, 0, 0.0, 0, (), 0)
+        helper_nodes = {}
+        running = len(helpers)
+        finished = False
+
+        def drain(block=False):
+            nonlocal best, running
+            while running:
+                try:
+                    k, d, mv, sc, nodes = results.get(block, 1.0)
+                except Exception:
+                    return
+                helper_nodes[k] = nodes
+                if d is None:
+                    running -= 1
+                elif mv is not None and d > best.depth:
+                    # 辅助进程的主要变例从共享的置换表里重建
+                    root = MutablePosition(pos) if MAKE_UNMAKE else PositionStack(pos)
+                    best = self.info(d, mv, sc, self.principal_variation(root, d))
+
+        def finish():
+            nonlocal finished
+            finished = True
+            own_nodes = self.nodes
+            stop.set()
+            deadline = time.time() + 2.0
+            while running and time.time() < deadline:
+                drain(block=True)
+            for p in helpers:
+                p.join(max(0.0, deadline - time.time()))
+                if p.is_alive():
+                    p.terminate()
+                    p.join()
+            results.close()
+            self.nodes = own_nodes + sum(helper_nodes.values())
+
+        try:
+            last = None
+            for info in self.search_serial(pos, history, tm, max_depth, limits=limits):
+                drain()
+                if info.move is not None and info.depth >= best.depth:
+                    best = info
+                last = best
+                yield best._replace(nodes=self.nodes + sum(helper_nodes.values()))
+            finish()
+            # 辅助进程在主进程结束前可能完成了更深的一层
+            if best.move is not None and best is not last:
+                yield best._replace(nodes=self.nodes)
+        finally:
+            if not finished:
+                finish()
+
+    def search_serial(self, pos, history=(), time_limit=None, max_depth=None, min_depth=None, limits=None):
         self.nodes = 0
+        self.seldepth = 0
         self.calc_average()
         pos.set()
         
         # 用“从头算的粗评估”作为搜索基准分，避免每回合基准乱跳
         pos = Position(pos.board, pos.score_rough, pos.turn, pos.version).set()
         
-        print("AI rough eval: %d" % pos.score_rough)
+        if not self.quiet:
+            print("AI rough eval: %d" % pos.score_rough)
 
         if DRAW_TEST:
             self.history = set(history)
-            # print('# Clearing table due to new history')
-            self.tp_score.clear()
+        if not self.shared_tp:
+            self.new_search(pos)
     
         # -----------------------------
         # Time control (NEW)
         # 关键：把时间限制下沉到 alphabeta 内部做“可中断检查”
-        # 这里仅负责设置起始时间与上限，并在超时后用“上一层已完成结果”返回
+        # 硬限制交给 alphabeta 中断搜索; 每完成一层由 TimeManager 决定是否开始下一层, 超时后用“上一层已完成结果”返回
         # -----------------------------
-        self.start_time = time.time()
-        self.time_limit = THINK_TIME if time_limit is None else float(time_limit)
+        tm = time_limit if isinstance(time_limit, TimeManager) else TimeManager(
+            THINK_TIME if time_limit is None else float(time_limit))
+        self.time_manager = tm
+        self.limits = SearchLimits() if limits is None else limits
+        # 第一层搜完之前不按用时中断, 时间再少也能给出一步; 节点数上限和外部停止信号照常有效
+        self.limits.start, self.limits.hard = tm.start, float('inf')
+        self.limits.reset()
+        if max_depth is None:
+            max_depth = self.limits.depth
+        root = MutablePosition(pos) if MAKE_UNMAKE else PositionStack(pos)
     
         last_move = None
         last_score = 0
         last_depth = 0
+        last = None
     
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
-        for depth in range(MIN_DEPTH, MAX_DEPTH + 1):
+        for depth in range(MIN_DEPTH if min_depth is None else min_depth,
+                           (MAX_DEPTH if max_depth is None else max_depth) + 1):
             try:
-                # The inner loop is a binary search on the score of the position.
-                # Inv: lower <= score <= upper
-                # 'while lower != upper' would work, but play tests show a margin of 20 plays
-                # better.
-                lower, upper = -MATE_UPPER, MATE_UPPER
-                val = self.alphabeta(pos, lower, upper, depth,
-                     nullmove=NULLMOVE, nullmove_now=NULLMOVE)
-
-                mv = self.tp_move.get(pos)
+                # 期望窗口(aspiration window): 以上一层的分数为中心的窄窗口, 失败高/失败低时向失败的一侧加倍放宽重搜。
+                # 第一层或上一层是杀棋分数时用全窗口。researches为本层重搜的次数, 随结果一起yield。
+                delta = ASPIRATION_DELTA
+                if delta and last_depth and abs(last_score) < MATE_LOWER:
+                    lower, upper = max(last_score - delta, -MATE_UPPER), min(last_score + delta, MATE_UPPER)
+                else:
+                    lower, upper = -MATE_UPPER, MATE_UPPER
+                researches = 0
+                self.root_scores = {}
+                self.fail_high = None
+                while True:
+                    val = self.alphabeta(root, lower, upper, depth,
+                         nullmove=NULLMOVE, nullmove_now=NULLMOVE)
+                    if val <= lower and lower > -MATE_UPPER:
+                        delta *= 2
+                        lower = max(val - delta, -MATE_UPPER)
+                    elif val >= upper and upper < MATE_UPPER:
+                        # 重搜时alphabeta会清空root_scores, 失败高的证明留给partial_result
+                        self.fail_high = (self.root_scores, self.root_alpha)
+                        delta *= 2
+                        upper = min(val + delta, MATE_UPPER)
+                    else:
+                        break
+                    researches += 1
+
+                mv = self.tp.get_move(pos.zobrist_hash)
                 sc = val
     
                 # 记录“已完成的一整层”的最佳结果：超时后用它作为最终落子
+                info = self.info(depth, mv, sc, self.principal_variation(root, depth), researches)
                 if mv is not None:
                     last_move, last_score, last_depth = mv, sc, depth
-    
-                yield depth, mv, sc
-    
+                    last = info
+                self.limits.retime(tm)
+
+                yield info
+                if not tm.done(mv):
+                    return
+
             except TimeoutError:
-                # 超时：不要等这一层跑完，直接返回上一层已完成的结果
-                if last_move is not None:
-                    yield last_depth, last_move, last_score
+                # 超时：不要等这一层跑完。这一层已经搜完、且证明比上一层最佳着法更好的着法优先, 否则返回上一层已完成的结果
+                partial = self.partial_result(pos, depth, last)
+                if partial is not None:
+                    yield partial
+                elif last_move is not None:
+                    yield last._replace(researches=0)
                 return
 
     def calc_average(self, version=0):
-        numr, numb = sum(di[version][True][key] for key in di[version][True]), sum(di[version][False][key] for key in di[version][False])
-        averagecoveredr, averagecoveredb = 0, 0
-        averager, averageb = {}, {}
+        '''
+        按暗子池计算双方暗子的平均价值, 存入average[version]。暗子池没变时直接取average_table的缓存。
+        '''
+        averagecoveredr, averager = average_table(tuple(di[version][True].get(p, 0) for p in AVERAGE_PIECES))
+        averagecoveredb, averageb = average_table(tuple(di[version][False].get(p.lower(), 0) for p in AVERAGE_PIECES))
+        self.average = {True: {False: averagecoveredr, True: averager}, False: {False: averagecoveredb, True: averageb}}
+        average[version] = self.average
+        return self.average
 
-        if numr == 0:
-            averagecoveredr = 0
-            for i in range(51, 204):
-                averager[i] = 0
 
-        else:
-            sumr = 0
-            for key in di[version][True]:
-                sumr += pst["1"][key] * di[version][True][key] / discount_factor
-            averagecoveredr = round(sumr/numr)
-
-            for i in range(51, 204):
-                sumr = 0
-                for key in di[version][True]:
-                    sumr += pst[key][i] * di[version][True][key]
-                averager[i] = round(sumr/numr)
-
-        if numb == 0:
-            averagecoveredb = 0
-            for i in range(51, 204):
-                averageb[i] = 0
+class Ponder:
+    '''
+    后台思考: 电脑走完以后, 按主要变例猜对手的应着, 在对手思考期间用后台线程搜索猜中后的局面。
+    猜中(hit)时搜索不中断, 从这时起按给定的TimeManager的限制计时, 已经完成的层和置换表都直接沿用;
+    没猜中(miss)时通过停止信号中断, 与超时走同一条TimeoutError路径, 之后照常搜索实际局面, 置换表仍然保留。
+    '''
 
-        else:
-            sumb = 0
-            for key in di[version][False]:
-                sumb += pst["1"][key.swapcase()] * di[version][False][key] / discount_factor
-            averagecoveredb = round(sumb/numb)
+    def __init__(self, searcher):
+        self.searcher = searcher
+        self.thread = None
+        self.move = None
+        self.infos = []
+        self.stop = threading.Event()
+        self.manager = None
 
-            for i in range(51, 204):
-                sumb = 0
-                for key in di[version][False]:
-                    sumb += pst[key.swapcase()][i] * di[version][False][key]
-                averageb[i] = round(sumb/numb)
+    def start(self, pos, move, history=()):
+        '''
+        pos: 对手走了move之后的局面(电脑走子方视角)
+        '''
+        self.miss()
+        self.move = move
+        self.infos = []
+        self.stop.clear()
+        self.manager = TimeManager(float('inf'))
+        self.thread = threading.Thread(target=self._run, args=(pos, list(history)), daemon=True)
+        self.thread.start()
+
+    def _run(self, pos, history):
+        searcher = self.searcher
+        searcher.quiet = True
+        try:
+            for info in searcher.search(pos, history, time_limit=self.manager, limits=SearchLimits(stop=self.stop)):
+                self.infos.append(info)
+        finally:
+            searcher.quiet = False
+
+    def interrupt(self):
+        self.stop.set()
+
+    def hit(self, manager):
+        '''
+        猜中: 正在进行的搜索从现在起按manager的软/硬限制计时, 返回后台搜索每一层的结果
+        '''
+        self.manager.set_limits(manager.hard, manager.soft)
+        self.searcher.retime(self.manager)
+        self.thread.join()
+        self.thread = None
+        return self.infos
+
+    def miss(self):
+        if self.thread is not None:
+            self.interrupt()
+            self.thread.join()
+            self.thread = None
+
+    def resolve(self, move):
+        '''
+        对手实际走了move, 在mymove_check/setcache改动暗子池等全局状态之前调用: 没猜中就立即停止后台思考,
+        免得后台搜索读到走子过程中改了一半的全局状态。猜的着法不翻子也不吃暗子, 猜中时走子不改变暗子池, 搜索继续。
+        '''
+        if self.thread is not None and move != self.move:
+            self.miss()
 
-        self.average = {True: {False: averagecoveredr, True: averager}, False: {False: averagecoveredb, True: averageb}}
-        average[version] = self.average
-        return self.average
+    def finish(self, move, manager):
+        '''
+        对手实际走了move: 猜中且后台搜索已有结果时返回这些结果, 否则停止后台思考并返回None
+        '''
+        if self.thread is None:
+            return None
+        if move != self.move:
+            self.miss()
+            return None
+        return self.hit(manager) or None
 
 
 ###############################################################################
@@ -1178,6 +2772,22 @@ def render_tuple(t, reverse=False):
     return render(t[0], reverse) + render(t[1], reverse)
 
 
+def render_pv(pv, reverse=False):
+    '''
+    主要变例里双方的着法交替, 对方的着法是对方视角的坐标, 要反过来; reverse为True时根节点是黑方(电脑)视角
+    '''
+    return [render_tuple(move, (k % 2 == 1) != reverse) for k, move in enumerate(pv)]
+
+
+def format_info(info, reverse=False):
+    '''
+    把SearchInfo格式化成一行 "info depth ... pv ..."
+    '''
+    pv = ' '.join(render_pv(info.pv, reverse))
+    return 'info depth %d seldepth %d score %d nodes %d nps %d time %d hashfull %d pv %s' % (
+        info.depth, info.seldepth, info.score, info.nodes, info.nps, int(info.time * 1000), info.hashfull, pv)
+
+
 def print_pos(pos):
     chessstr = ''
     for i, row in enumerate(pos.board.split()):
@@ -1189,10 +2799,8 @@ def print_pos(pos):
     return chessstr
 
 def side_to_move_in_check(pos) -> bool:
-    # 当前走子方的王/将是大写 'K'
-    # 对手的攻击检测：把局面 rotate，让对手成为走子方
-    opp = pos.rotate()
-    return any(opp.board[m[1]] == 'k' for m in opp.gen_moves())
+    # 当前走子方的王/将是大写 'K', 从帅的位置向外找对方的攻击者
+    return pos.in_check()
 
 def random_policy(pos):
     '''
@@ -1294,6 +2902,9 @@ def main(random_move=False, AI=True, debug=False):
     setcache(hist[-1].board)
     searcher = Searcher()
     searcher.calc_average()
+    ponder = Ponder(searcher)
+    ponder_move = None  # 上一步主要变例里猜的玩家应着
+    ai_clock = GAME_CLOCK  # 电脑棋钟的剩余时间(秒)
     myeatlist = []
     AIeatlist = []
     step = 0
@@ -1317,16 +2928,15 @@ def main(random_move=False, AI=True, debug=False):
             move = kaijuku[pos.board]
             return _depth, move, 0, 0
     
-        tlim = get_think_time(step)   # NEW
-        start = time.time()
+        tm = TimeManager(get_think_time(step))
         generate_forbiddenmoves(pos, check_bozi=True, step=step)
-        
+
         last_depth, last_move, last_score = 0, None, 0
-        for d, mv, sc in searcher.search(pos, hist, time_limit=tlim):   # NEW
-            last_depth, last_move, last_score = d, mv, sc
-            if time.time() - start > tlim:   # NEW
-                break
-    
+        # 是否开始下一层、何时中断都由TimeManager决定
+        for info in searcher.search(pos, hist, time_limit=tm):
+            print(format_info(info), flush=True)
+            last_depth, last_move, last_score = info.depth, info.move, info.score
+
         nodes = getattr(searcher, "nodes", 0)
         return last_depth, last_move, int(last_score), int(nodes)
 
@@ -1342,7 +2952,12 @@ def main(random_move=False, AI=True, debug=False):
             break
 
         move = None
-        genmoves = set(hist[-1].gen_moves())
+        genmoves = set(hist[-1].legal_moves())
+        if not genmoves:
+            # 被将死或困毙
+            dump_scores()
+            print("You lost", flush=True)
+            break
 
         if SELF_PLAY and (not debug):
             _depth, move, score, nodes = pick_ai_move(hist[-1], step)
@@ -1378,6 +2993,8 @@ def main(random_move=False, AI=True, debug=False):
                     print("Please enter a move like h2e2")
 
 
+        # 玩家的着法改动暗子池等全局状态之前, 没猜中的后台思考先停下
+        ponder.resolve(move)
         pos, win, eat, dst = hist[-1].mymove_check(
             move,
             discount_red=True,
@@ -1410,9 +3027,15 @@ def main(random_move=False, AI=True, debug=False):
         if side_to_move_in_check(hist[-1]):
             print("Check!", flush=True)
 
+        if not hist[-1].legal_moves():
+            dump_scores()
+            print("You win!", flush=True)
+            break
+
         # Fire up the engine to look for a move.
         _depth = 0
 
+        player_move = move
         move, score = None, 0  # 确保每轮都有初值
         nodes = 0
         if AI:
@@ -1426,16 +3049,29 @@ def main(random_move=False, AI=True, debug=False):
                     # 若你更想给开局库也一个“粗评估”，可用下面一行替换 score=0：
                     # score = int(hist[-1].score_rough)
                 else:
-                    tlim = get_think_time(step)   # NEW
-                    start = time.time()
-                    generate_forbiddenmoves(hist[-1], check_bozi=True, step=step)
-                    for _depth, move, score in searcher.search(hist[-1], hist, time_limit=tlim):  # NEW
-                        if time.time() - start > tlim:   # NEW
-                            break
+                    if GAME_CLOCK:
+                        tm = TimeManager.from_clock(ai_clock, CLOCK_INCREMENT)
+                    else:
+                        tm = TimeManager(get_think_time(step))
+                    pondered = ponder.finish(player_move, tm)
+                    info = None
+                    if pondered:
+                        # 猜中了玩家的应着, 后台搜索的结果接着用
+                        for info in pondered:
+                            print(format_info(info, reverse=True), flush=True)
+                        info = pondered[-1]
+                        _depth, move, score = info.depth, info.move, info.score
+                    else:
+                        generate_forbiddenmoves(hist[-1], check_bozi=True, step=step)
+                        for info in searcher.search(hist[-1], hist, time_limit=tm):
+                            print(format_info(info, reverse=True), flush=True)
+                            _depth, move, score = info.depth, info.move, info.score
+                    ai_clock += CLOCK_INCREMENT - tm.elapsed()
+                    ponder_move = info.pv[1] if info is not None and len(info.pv) > 1 else None
                     nodes = getattr(searcher, "nodes", 0)
 
         else:
-            genmoves = set(hist[-1].gen_moves())
+            genmoves = set(hist[-1].legal_moves())
             while move not in genmoves:
                 match = re.match('([a-i][0-9])' * 2, input('Your move: '))
                 if match:
@@ -1450,8 +3086,9 @@ def main(random_move=False, AI=True, debug=False):
             score_list.append(int(score))
 
 
-        if score == MATE_UPPER:
-            print("Checkmate!")
+        if score >= MATE_LOWER:
+            # 杀棋分数是MATE_UPPER减去被将死一方无着可走时离根节点的步数
+            print("Mate in %d" % ((MATE_UPPER - score + 1) // 2))
 
         # The black player moves from a rotated position, so we have to
         # 'back rotate' the move before printing it.
@@ -1481,6 +3118,16 @@ def main(random_move=False, AI=True, debug=False):
         # 如果玩家此刻被将军，则输出提示
         if side_to_move_in_check(hist[-1]):
             print("Check!", flush=True)
+
+        # 后台思考: 只猜不翻暗子、不吃暗子的应着, 这样猜中后的局面是确定的, 暗子池也和后台搜索时一样
+        if PONDER and AI and not random_move and not SELF_PLAY and not debug and ponder_move is not None \
+                and hist[-1].board[ponder_move[0]] in 'RNBAKCP' and hist[-1].board[ponder_move[1]] not in 'defghiu' \
+                and ponder_move in hist[-1].legal_moves():
+            guess = hist[-1].mymove_check(ponder_move, discount_red=False, discount_black=False)[0]
+            searcher.calc_average()
+            generate_forbiddenmoves(guess, check_bozi=True, step=step + 1)
+            ponder.start(guess, ponder_move, hist + [guess])
+        ponder_move = None
         
         if debug:
            print("RETURN FROM DEBUG MODE!")
@@ -1490,6 +3137,7 @@ def main(random_move=False, AI=True, debug=False):
         step += 1
     
 
+    ponder.miss()
     histdict = {}
     for i, history in enumerate(hist):
         histdict[i] = history.board
@@ -1497,8 +3145,290 @@ def main(random_move=False, AI=True, debug=False):
         json.dump(histdict, f)
 
 
+###############################################################################
+# UCCI protocol
+###############################################################################
+
+# FEN中的棋子字母(兼容h/e写法), x/X是暗子, 按所在的初始位置换成对应的暗子字母
+FEN_PIECES = {'r': 'R', 'n': 'N', 'h': 'N', 'b': 'B', 'e': 'B', 'a': 'A', 'k': 'K', 'c': 'C', 'p': 'P'}
+UCCI_MOVE_RE = re.compile(r'([a-i][0-9])([a-i][0-9])([a-zA-Z]?)([a-zA-Z]?)$')
+
+
+def parse_fen(fen):
+    '''
+    解析FEN的棋盘和走子方, 返回 (红方视角的棋盘, 是否红方走)。
+    暗子写作X(红)/x(黑), 只能在开局的位置上, 换成该位置的暗子字母(D-I/d-i)。
+    '''
+    fields = fen.split()
+    rows = fields[0].split('/')
+    if len(rows) != 10:
+        raise ValueError('bad fen: %s' % fen)
+    board = list(re.sub('[A-Za-z]', '.', initial_covered))
+    for k, row in enumerate(rows):
+        fil = 0
+        for c in row:
+            if c.isdigit():
+                fil += int(c)
+                continue
+            if fil > 8:
+                raise ValueError('bad fen: %s' % fen)
+            i = parse('abcdefghi'[fil] + str(9 - k))
+            if c in 'xX':
+                p = initial_covered[i]
+                if p.upper() not in 'DEFGHI' or p.isupper() != c.isupper():
+                    raise ValueError('covered piece off its initial square: %s' % render(i))
+            elif c.lower() in FEN_PIECES:
+                p = FEN_PIECES[c.lower()]
+                p = p if c.isupper() else p.lower()
+            else:
+                raise ValueError('bad fen piece: %s' % c)
+            board[i] = p
+            fil += 1
+    red = len(fields) < 2 or fields[1] in 'wr'
+    return ''.join(board), red
+
+
+def reset_covered_pool(board):
+    '''
+    按棋盘重置暗子池: 每方完整的暗子池减去盘面上已经翻开的子。被吃掉的明子FEN里看不出来, 只能按还在暗子池里算。
+    '''
+    resetrbdict()
+    for p in board:
+        if p in 'RNBACPrnbacp':
+            pool = di[0][p.isupper()]
+            if pool[p] > 0:
+                pool[p] -= 1
+    for side in (True, False):
+        sumall[0][side] = sum(di[0][side].values())
+
+
+def apply_ucci_move(pos, token):
+    '''
+    走一步UCCI着法(红方视角坐标), 返回新局面(对方走子方视角)。
+    揭棋扩展: 着法后面可以跟棋子字母, 翻开的暗子是什么就写在第5个字符; 吃掉的暗子如果知道是什么, 写在最后。
+    走子的不是暗子时, 唯一的后缀就是被吃暗子。例如 a0a1r, h2h9rn, b2b9n。字母大小写不限, 按走子方决定颜色。
+    翻开、吃掉的暗子从对应一方的暗子池里扣除。
+    '''
+    match = UCCI_MOVE_RE.match(token)
+    if not match:
+        raise ValueError('bad move: %s' % token)
+    i, j = parse(match.group(1)), parse(match.group(2))
+    if not pos.turn:
+        i, j = 254 - i, 254 - j
+    if (i, j) not in set(pos.legal_moves()):
+        raise ValueError('illegal move: %s' % token)
+    suffix = [FEN_PIECES.get(c.lower()) for c in match.group(3) + match.group(4)]
+    if None in suffix:
+        raise ValueError('bad piece in move: %s' % token)
+    p, q = pos.board[i], pos.board[j]
+    pool, opp_pool = di[pos.version][pos.turn], di[pos.version][not pos.turn]
+    if p in 'DEFGHI':
+        if not suffix:
+            raise ValueError('covered piece moved without its identity: %s' % token)
+        p = suffix.pop(0)
+        key = p if pos.turn else p.lower()
+        if pool.get(key, 0) > 0:
+            pool[key] -= 1
+    if q in 'defghi' and suffix:
+        key = suffix[0].lower() if pos.turn else suffix[0]
+        if opp_pool.get(key, 0) > 0:
+            opp_pool[key] -= 1
+    for side in (True, False):
+        sumall[pos.version][side] = sum(di[pos.version][side].values())
+    board = put(put(pos.board, j, p), i, '.')
+    return Position.rotate_new(board, pos.score, pos.turn, pos.version)
+
+
+class UCCIEngine:
+    '''
+    UCCI协议模式(https://www.xqbase.com/protocol/cchess_ucci.htm), 用于对弈平台和其他程序调用:
+    ucci, isready, setoption usebook, position {fen <FEN> | startpos} [moves ...], banmoves, go, ponderhit, stop, quit。
+    go支持 time <剩余毫秒> [increment <毫秒>] [movestogo <步数>], depth <深度>, nodes <节点数>, infinite, ponder。
+    time按棋钟交给TimeManager分配。go ponder时不限时搜索, 收到ponderhit后从此刻起按time分配的限制计时,
+    收到stop则立即停止; 这期间不输出bestmove。
+    搜索在后台线程里进行, 期间仍然读命令, stop通过SearchLimits的停止信号中断搜索, 与超时走同一条TimeoutError路径。
+    每完成一层输出 info, 结束时输出 bestmove。不打印棋盘, 其他输出(搜索中的调试信息)都转到stderr。
+    '''
+
+    def __init__(self, out):
+        self.out = out
+        self.searcher = Searcher()
+        self.usebook = True
+        self.hist = []
+        self.banned = set()
+        self.thread = None
+        self.stop = threading.Event()
+        self.pondering = False
+        self.manager = None
+        self.ponder_manager = None
+        self.set_position(initial_covered, True, [])
+
+    def send(self, line):
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def set_position(self, board, red, moves):
+        reset_covered_pool(board)
+        cache.clear()
+        pos = Position(board, 0, True, 0).set()
+        if not red:
+            pos = pos.rotate()
+        hist = [pos]
+        setcache(pos.board)
+        for token in moves:
+            pos = apply_ucci_move(pos, token)
+            hist.append(pos)
+            setcache(pos.board)
+        self.hist = hist
+        self.banned = set()
+
+    def run(self, line):
+        '''
+        处理一行命令, 返回False表示退出
+        '''
+        words = line.split()
+        if not words:
+            return True
+        cmd, args = words[0], words[1:]
+        if cmd == 'ucci':
+            self.send('id name musesfish')
+            self.send('id author miaosiSari')
+            self.send('option usebook type check default true')
+            self.send('ucciok')
+        elif cmd == 'isready':
+            self.send('readyok')
+        elif cmd == 'setoption':
+            if len(args) >= 2 and args[0] == 'usebook':
+                self.usebook = args[1] in ('true', 'on', '1')
+        elif cmd == 'position':
+            self.halt()
+            if 'moves' in args:
+                k = args.index('moves')
+                args, moves = args[:k], args[k + 1:]
+            else:
+                moves = []
+            try:
+                if args and args[0] == 'fen':
+                    board, red = parse_fen(' '.join(args[1:]))
+                else:
+                    board, red = initial_covered, True
+                self.set_position(board, red, moves)
+            except ValueError as e:
+                self.send('info string %s' % e)
+        elif cmd == 'banmoves':
+            pos = self.hist[-1]
+            for token in args:
+                match = UCCI_MOVE_RE.match(token)
+                if match:
+                    i, j = parse(match.group(1)), parse(match.group(2))
+                    self.banned.add((i, j) if pos.turn else (254 - i, 254 - j))
+        elif cmd == 'go':
+            self.halt()
+            self.go(args)
+        elif cmd == 'ponderhit':
+            if self.pondering:
+                self.pondering = False
+                self.manager.set_limits(self.ponder_manager.hard, self.ponder_manager.soft)
+                self.searcher.retime(self.manager)
+        elif cmd == 'stop':
+            self.halt()
+        elif cmd == 'quit':
+            self.halt()
+            return False
+        return True
+
+    def go(self, args):
+        opts = {}
+        for k, word in enumerate(args):
+            if word in ('time', 'increment', 'movestogo', 'depth', 'nodes'):
+                try:
+                    opts[word] = int(args[k + 1])
+                except (IndexError, ValueError):
+                    # 缺少参数或参数不是整数: 不开始搜索, 继续读命令
+                    self.send('info string bad go argument')
+                    return
+        if 'time' in opts:
+            manager = TimeManager.from_clock(opts['time'] / 1000.0, opts.get('increment', 0) / 1000.0,
+                                             opts.get('movestogo', 0))
+        elif 'depth' in opts or 'nodes' in opts or 'infinite' in args:
+            manager = TimeManager(float('inf'))
+        else:
+            manager = TimeManager(THINK_TIME)
+        self.pondering = 'ponder' in args
+        if self.pondering:
+            self.ponder_manager, manager = manager, TimeManager(float('inf'))
+        self.manager = manager
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.think, daemon=True,
+                                       args=(manager, opts.get('depth'), opts.get('nodes', 0)))
+        self.thread.start()
+
+    def think(self, manager, max_depth, node_limit):
+        global forbidden_moves
+        pos = self.hist[-1]
+        reverse = not pos.turn
+        move, info = None, None
+        if self.usebook and pos.board in kaijuku:
+            move = kaijuku[pos.board]
+        elif pos.legal_moves():
+            # 禁着的判断要用到当前暗子池的平均价值
+            self.searcher.calc_average()
+            generate_forbiddenmoves(pos, check_bozi=True, step=len(self.hist) // 2)
+            forbidden_moves |= self.banned
+            limits = SearchLimits(nodes=node_limit, depth=max_depth, stop=self.stop)
+            depth = 0
+            for info in self.searcher.search(pos, self.hist, time_limit=manager, limits=limits):
+                if info.depth > depth:
+                    # 超时后search会再给出一次上一层的结果, 不重复输出
+                    if info.partial:
+                        self.send('info string partial')
+                    self.send(format_info(info, reverse))
+                    depth = info.depth
+                move = info.move
+        while self.pondering and not self.stop.is_set():
+            # 后台思考提前搜完了, 等ponderhit或stop再输出
+            self.stop.wait(0.05)
+        if move is None:
+            self.send('nobestmove')
+        elif info is not None and len(info.pv) > 1 and info.pv[0] == move:
+            self.send('bestmove %s ponder %s' % (render_tuple(move, reverse), render_tuple(info.pv[1], not reverse)))
+        else:
+            self.send('bestmove %s' % render_tuple(move, reverse))
+
+    def interrupt(self):
+        self.stop.set()
+
+    def halt(self):
+        self.pondering = False
+        self.interrupt()
+        self.wait()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def ucci():
+    '''
+    UCCI模式的主循环: 协议输出写到原来的stdout, 其他print都转到stderr
+    '''
+    global mapping
+    mapping = B.translate_mapping(B.mapping)
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    engine = UCCIEngine(out)
+    for line in sys.stdin:
+        if not engine.run(line.strip()):
+            break
+    engine.halt()
+
+
 if __name__ == '__main__':
-    main(random_move=False, AI=True, debug=False)
+    if 'ucci' in sys.argv[1:] or '--ucci' in sys.argv[1:]:
+        ucci()
+    else:
+        main(random_move=False, AI=True, debug=False)
     '''
     b = Position(initial_covered, 0, True, 0).set()
     s = Searcher()
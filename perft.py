@@ -0,0 +1,197 @@
+#!/usr/bin/env pypy
+# -*- coding: utf-8 -*-
+'''
+走法生成器的perft基准与正确性校验
+
+perft: 从给定局面出发, 穷举走到第N层, 统计叶子节点数和每秒节点数(nps)。
+吃将的着法视为对局结束, 计为叶子但不再展开(引擎是吃将引擎, 没有将死判断)。
+同时分别测量 Position.gen_moves() / Position.move() / Position.value() 的吞吐量,
+并把 gen_moves() 的结果与 board.Board 的 get_legal_moves_speedup / stupid_generate_all_legal_moves 逐局面比对。
+
+用法:
+    python perft.py                  # 默认深度3, 两种搜索内核都测
+    python perft.py --depth 4 --check 2 --core mutable
+'''
+
+from __future__ import print_function
+import argparse
+import time
+from board import board, common, library
+import musesfish_pvs_20260215 as engine
+
+
+def setup():
+    '''
+    初始化引擎的全局状态(暗子集合/平均价值表), value()依赖这些表
+    '''
+    engine.resetrbdict()
+    engine.mapping = engine.B.translate_mapping(engine.B.mapping)
+    engine.Searcher().calc_average()
+
+
+def suite():
+    '''
+    返回 [(名称, Position)], 包括初始局面、bug局面和开局库中的所有局面。
+    开局库的局面是电脑(黑方)视角, 因此turn为False。
+    '''
+    positions = [('initial_covered', engine.Position(engine.initial_covered, 0, True, 0).set()),
+                 ('bug', engine.Position(engine.bug, 0, True, 0).set())]
+    for n, b in enumerate(library.kaijuku):
+        positions.append(('kaijuku_%d' % n, engine.Position(b, 0, False, 0).set()))
+    return positions
+
+
+def perft(pos, depth):
+    '''
+    pos: MutablePosition 或 PositionStack (make/unmake接口)
+    '''
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in list(pos.gen_moves()):
+        if pos.board[move[1]] == 'k':
+            nodes += 1
+            continue
+        pos.make(move)
+        nodes += perft(pos, depth - 1)
+        pos.unmake()
+    return nodes
+
+
+def throughput(pos, seconds=1.0):
+    '''
+    分别测量 gen_moves / move / value 每秒的调用次数
+    '''
+    moves = list(pos.gen_moves())
+    result = {}
+
+    def _measure(name, fn, per_call):
+        n, start = 0, time.time()
+        while time.time() - start < seconds:
+            fn()
+            n += per_call
+        result[name] = n / (time.time() - start)
+
+    _measure('gen_moves', lambda: list(pos.gen_moves()), 1)
+    _measure('move', lambda: [pos.move(m) for m in moves], len(moves))
+    _measure('value', lambda: [pos.value(m) for m in moves], len(moves))
+    return result
+
+
+###############################################################################
+# 与 board.Board 比对
+###############################################################################
+
+# 引擎字符 -> board.Board 的整数编码。引擎总是走子方在下(大写), 对应Board中的红方。
+_codes = {'R': 1, 'N': 2, 'B': 3, 'A': 4, 'K': 5, 'C': 6, 'P': 7,
+          'D': 1 + common.MASK_CHESS_ISCOVERED, 'E': 2 + common.MASK_CHESS_ISCOVERED,
+          'F': 3 + common.MASK_CHESS_ISCOVERED, 'G': 4 + common.MASK_CHESS_ISCOVERED,
+          'H': 6 + common.MASK_CHESS_ISCOVERED, 'I': 7 + common.MASK_CHESS_ISCOVERED,
+          'U': common.MASK_CHESS_UNCERTAIN}
+
+
+def to_board(b):
+    '''
+    把256字符的棋盘转成 board.Board 的 (board, chessdict)
+    '''
+    arr = [[0] * 9 for _ in range(10)]
+    chessdict = {}
+    for i in engine.board_squares:
+        p = b[i]
+        if p == '.':
+            continue
+        code = _codes[p.upper()]
+        if p.isupper():
+            code += common.MASK_COLOR
+        x, y = 12 - (i >> 4), (i & 15) - 3
+        arr[x][y] = code
+        chessdict[(x, y)] = code
+    return arr, chessdict
+
+
+def _to_square(t):
+    return ((12 - t[0]) << 4) + 3 + t[1], ((12 - t[2]) << 4) + 3 + t[3]
+
+
+def cross_check(pos, checker):
+    '''
+    比对一个局面的着法集合, 返回 [(方法名, 引擎多出的着法, 引擎缺少的着法)], 一致时返回空列表。
+    stupid_generate_all_legal_moves 不支持不确定子U, 含U的局面只比对 get_legal_moves_speedup。
+    '''
+    arr, chessdict = to_board(pos.board)
+    shuaijiang = checker.search_kings(arr)
+    mine = set(pos.gen_moves())
+    errors = []
+    speedup = set(map(_to_square, checker.get_legal_moves_speedup(
+        board=arr, turn=True, shuaijiang=shuaijiang, chessdict=chessdict)))
+    if speedup != mine:
+        errors.append(('get_legal_moves_speedup', mine - speedup, speedup - mine))
+    if 'U' not in pos.board and 'u' not in pos.board:
+        stupid = set(map(_to_square, checker.stupid_generate_all_legal_moves(
+            board=arr, turn=True, shuaijiang=shuaijiang)))
+        if stupid != mine:
+            errors.append(('stupid_generate_all_legal_moves', mine - stupid, stupid - mine))
+    return errors
+
+
+def check_tree(pos, depth, checker, found):
+    '''
+    在perft树的前depth层上逐局面比对, 不一致的局面记录到found
+    '''
+    errors = cross_check(pos, checker)
+    if errors:
+        found.append((''.join(pos.board), errors))
+    if depth <= 1:
+        return
+    for move in list(pos.gen_moves()):
+        if pos.board[move[1]] == 'k':
+            continue
+        pos.make(move)
+        check_tree(pos, depth - 1, checker, found)
+        pos.unmake()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Jieqi move generator perft benchmark')
+    parser.add_argument('--depth', type=int, default=3, help='perft depth')
+    parser.add_argument('--check', type=int, default=1, help='cross-check depth against board.Board (0: off)')
+    parser.add_argument('--core', choices=('mutable', 'copy', 'both'), default='both',
+                        help='mutable: MutablePosition, copy: Position.move() via PositionStack')
+    parser.add_argument('--seconds', type=float, default=0.5, help='time per throughput measurement')
+    args = parser.parse_args()
+
+    setup()
+    cores = {'mutable': engine.MutablePosition, 'copy': engine.PositionStack}
+    names = list(cores) if args.core == 'both' else [args.core]
+    checker = board.Board()
+    mismatches = 0
+
+    for name, pos in suite():
+        line = '%-16s' % name
+        for core in names:
+            root = cores[core](pos)
+            start = time.time()
+            nodes = perft(root, args.depth)
+            used = time.time() - start
+            line += '  %s: depth %d nodes %d time %.2fs nps %d' % (core, args.depth, nodes, used, nodes / max(used, 1e-9))
+        tp = throughput(pos, args.seconds)
+        line += '  gen_moves/s %d move/s %d value/s %d' % (tp['gen_moves'], tp['move'], tp['value'])
+        print(line, flush=True)
+
+        if args.check > 0:
+            found = []
+            check_tree(engine.MutablePosition(pos), args.check, checker, found)
+            for b, errors in found:
+                mismatches += 1
+                print('  MISMATCH:')
+                engine.print_pos(engine.Position(b, 0, True, 0))
+                for method, extra, missing in errors:
+                    print('    %s: engine extra %s, engine missing %s' % (
+                        method, sorted(map(engine.render_tuple, extra)), sorted(map(engine.render_tuple, missing))))
+
+    if args.check > 0:
+        print('cross-check: %d mismatching positions' % mismatches)
+
+
+if __name__ == '__main__':
+    main()